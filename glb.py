@@ -0,0 +1,609 @@
+from config import *
+
+import collections
+import hashlib
+import io
+import numpy as np
+import os
+import pygltflib
+import re
+
+from PIL import Image
+
+import gob
+import loader
+import models
+
+# builds the GLBs of levels and skins. this runs in the worker processes of the
+# server's pool, which import this module instead of the server and its web app
+
+
+def init_worker():
+    # runs once when a worker process starts
+    gob.open_official_gobs()
+
+    # the workers share the configured cache sizes (and the directories on disk)
+    workers = max(1, LEVEL_EXTRACTION_WORKERS)
+    loader.configure_decoded_material_cache(MATERIAL_CACHE_SIZE // workers, os.path.join(
+        'cache', 'materials-{}'.format(VERSION)) if MATERIAL_CACHE_ON_DISK and not DEVELOPMENT_MODE else None,
+        MATERIAL_CACHE_DISK_SIZE)
+    loader.configure_parsed_model_cache(MODEL_CACHE_SIZE // workers, os.path.join(
+        'cache', 'models-{}'.format(VERSION)) if MODEL_CACHE_ON_DISK and not DEVELOPMENT_MODE else None,
+        MODEL_CACHE_DISK_SIZE)
+
+
+def _use_texture_store():
+    # gltfpack needs the images in the GLB to compress them
+    return TEXTURE_STORE and GLTFPACK_PATH is None
+
+
+# divide vertex UVs by texture sizes
+def _normalize_uvs(surfaces, materials):
+    for surf in surfaces:
+        mat = materials[surf['material']]
+        if mat and 'dims' in mat:
+            sclu = 1.0 / mat['dims'][0]
+            sclv = 1.0 / mat['dims'][1]
+            for v in surf['vertices']:
+                v[1] = (v[1][0] * sclu, v[1][1] * sclv)
+
+
+def _make_materials_for_translucent_surfaces(surfaces, materials):
+    variants = {}
+    for surf in surfaces:
+        mat = surf['material']
+        if mat not in variants:
+            if surf['translucent']:
+                materials[mat]['translucent'] = True
+                variants[mat] = {'translucent': mat}
+            else:
+                variants[mat] = {'normal': mat}
+        else:
+            if surf['translucent']:
+                if 'translucent' not in variants[mat]:
+                    copy = materials[mat].copy()
+                    copy['translucent'] = True
+                    variants[mat]['translucent'] = len(materials)
+                    materials.append(copy)
+                surf['material'] = variants[mat]['translucent']
+            else:
+                if 'normal' not in variants[mat]:
+                    copy = materials[mat].copy()
+                    del copy['translucent']
+                    variants[mat]['normal'] = len(materials)
+                    materials.append(copy)
+                surf['material'] = variants[mat]['normal']
+
+
+def _pack_materials_into_atlases(surface_sources, other_sources, materials, atlas_size):
+    # packs the images of small materials into atlases and moves their surfaces over
+    # to them, so that they share a few primitives. only materials whose surfaces
+    # don't repeat the texture are packed, and none used by the other sources
+    max_image_size = atlas_size // 4
+    padding = 4  # edge pixels repeated around each image against bleeding
+    epsilon = 1e-3
+
+    candidates = {}
+    excluded = set(surf['material'] for surfaces in other_sources for surf in surfaces)
+    for surfaces in surface_sources:
+        for surf in surfaces:
+            index = surf['material']
+            mat = materials[index]
+            if not mat or 'image' not in mat or max(mat['dims']) > max_image_size:
+                excluded.add(index)
+            elif not all(-epsilon <= v[1][0] <= 1 + epsilon and -epsilon <= v[1][1] <= 1 + epsilon for v in surf['vertices']):
+                excluded.add(index)  # repeats its texture
+            else:
+                candidates.setdefault(index, []).append(surf)
+    for index in excluded:
+        candidates.pop(index, None)
+
+    # translucent and opaque materials are blended differently, so they get separate atlases
+    kinds = {False: [], True: []}
+    for index in candidates:
+        kinds['translucent' in materials[index]].append(index)
+
+    for translucent, indices in kinds.items():
+        # put the images onto shelves, tallest first
+        pages = [[]]
+        x = y = shelf_height = 0
+        for index in sorted(indices, key=lambda index: (-materials[index]['dims'][1], index)):
+            width, height = materials[index]['dims']
+            if x + width + 2 * padding > atlas_size:
+                x, y, shelf_height = 0, y + shelf_height, 0
+            if y + height + 2 * padding > atlas_size:
+                pages.append([])
+                x = y = shelf_height = 0
+            pages[-1].append((index, x + padding, y + padding))
+            x += width + 2 * padding
+            shelf_height = max(shelf_height, height + 2 * padding)
+
+        for page in pages:
+            if len(page) < 2:
+                continue  # nothing to share
+
+            atlas_width = max(px + materials[index]['dims'][0] + padding for index, px, _ in page)
+            atlas_height = max(py + materials[index]['dims'][1] + padding for index, _, py in page)
+            pixels = np.zeros((atlas_height, atlas_width, 4), dtype=np.uint8)
+            for index, px, py in page:
+                width, height = materials[index]['dims']
+                with Image.open(io.BytesIO(materials[index]['image'])) as image:
+                    image_pixels = np.asarray(image.convert('RGBA'))
+                pixels[py - padding:py + height + padding, px - padding:px + width + padding] = np.pad(
+                    image_pixels, ((padding, padding), (padding, padding), (0, 0)), mode='edge')
+
+            with io.BytesIO() as output:
+                Image.fromarray(pixels, 'RGBA').save(output, format='PNG')
+                atlas = {'color': tuple(np.mean([materials[index]['color'] for index, _, _ in page], axis=0).tolist()),
+                         'image': output.getvalue(), 'mime': 'image/png', 'dims': (atlas_width, atlas_height),
+                         'name': 'atlas', 'atlas': True}
+            if translucent:
+                atlas['translucent'] = True
+            atlas_index = len(materials)
+            materials.append(atlas)
+
+            # the images are flipped: v counts from the bottom, but the atlas rows from the top
+            for index, px, py in page:
+                width, height = materials[index]['dims']
+                for surf in candidates[index]:
+                    surf['material'] = atlas_index
+                    for v in surf['vertices']:
+                        s = min(max(v[1][0], 0.0), 1.0)
+                        t = min(max(v[1][1], 0.0), 1.0)
+                        v[1] = ((px + s * width) / atlas_width,
+                                -(py + (1 - t) * height) / atlas_height)
+                materials[index] = None  # no longer used
+
+
+def _new_gltf():
+    # all buffer views live in a single buffer that is stored in the GLB's
+    # binary chunk, so no data needs to be base64 encoded
+    gltf = pygltflib.GLTF2()
+    gltf.buffers.append(pygltflib.Buffer(byteLength=0))
+    gltf.set_binary_blob(bytearray())
+    return gltf
+
+
+def _add_buffer_view(gltf, data, **kwargs):
+    blob = gltf.binary_blob()
+    blob.extend(b'\0' * (-len(blob) % 4))  # keep buffer views 4-byte aligned
+    buffer_view = pygltflib.BufferView(
+        buffer=0, byteOffset=len(blob), byteLength=len(data), **kwargs)
+    blob.extend(data)
+    gltf.buffers[0].byteLength = len(blob)
+    gltf.bufferViews.append(buffer_view)
+    return len(gltf.bufferViews) - 1
+
+
+def _srgb_to_linear(c):
+    c /= 255.0
+    return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+
+
+def _add_materials_to_gltf(gltf, materials, textures=None, separate=False):
+    # given a dict of textures, the images are put in there by name for the texture
+    # store instead of being embedded. separate textures are not referenced by the
+    # GLB at all: the materials then have the average color of their image, and the
+    # name in their extras for the viewer to load the image later
+    gltf.extensionsUsed.append('KHR_materials_unlit')
+    clamp_sampler = None
+    stored_images = {}
+    for mat in materials:
+        material = pygltflib.Material()
+        if mat and 'image' in mat:
+            material.pbrMetallicRoughness = pygltflib.PbrMetallicRoughness()
+            if textures is not None:
+                name = '{0}.{1}'.format(hashlib.sha1(
+                    mat['image']).hexdigest(), mat['mime'].split('/')[1])
+                textures[name] = mat['image']
+            if not separate:
+                if textures is None:
+                    buffer_view = _add_buffer_view(gltf, mat['image'])
+                    source = len(gltf.images)
+                    gltf.images.append(pygltflib.Image(
+                        mimeType=mat['mime'], bufferView=buffer_view))
+                elif name in stored_images:
+                    source = stored_images[name]  # e.g. of a translucent copy
+                else:
+                    source = stored_images[name] = len(gltf.images)
+                    gltf.images.append(pygltflib.Image(
+                        mimeType=mat['mime'], uri='../textures/' + name))
+                texture = pygltflib.Texture(source=source)
+                if 'atlas' in mat:
+                    # atlases must not wrap around, their images don't repeat
+                    if clamp_sampler is None:
+                        clamp_sampler = len(gltf.samplers)
+                        gltf.samplers.append(pygltflib.Sampler(
+                            wrapS=pygltflib.CLAMP_TO_EDGE, wrapT=pygltflib.CLAMP_TO_EDGE))
+                    texture.sampler = clamp_sampler
+                material.pbrMetallicRoughness.baseColorTexture = pygltflib.TextureInfo(
+                    index=len(gltf.textures))
+                gltf.textures.append(texture)
+                color = [1.0, 1.0, 1.0]
+            else:
+                material.extras = {'texture': name}
+                if 'atlas' in mat:
+                    material.extras['clamp'] = True
+                color = [_srgb_to_linear(c) for c in mat['color'][:3]]
+                material.pbrMetallicRoughness.baseColorFactor = color + [1.0]
+            if 'translucent' in mat:
+                material.alphaMode = pygltflib.BLEND
+                material.pbrMetallicRoughness.baseColorFactor = color + [90.0 / 255.0]
+                material.alphaCutoff = None
+            else:
+                material.alphaMode = pygltflib.MASK
+                material.alphaCutoff = 1.0 / 255.0
+            material.extensions['KHR_materials_unlit'] = {}
+        gltf.materials.append(material)
+
+
+def _build_vertex_and_index_arrays(surfaces, skip_color):
+    # gather the vertices of all surfaces in one go and let numpy do the rest
+    flat = [v for surf in surfaces for v in surf['vertices']]
+    positions = np.array([v[0] for v in flat], dtype=np.float64).reshape(-1, 3)
+    bounds = [positions.min(axis=0).tolist(), positions.max(axis=0).tolist()]
+
+    # interleaved layout: position, uv, color (optional)
+    vertices = np.empty((len(flat), 5 if skip_color else 8), dtype=np.float32)
+    vertices[:, 0:3] = positions
+    vertices[:, 3:5] = np.array([v[1] for v in flat], dtype=np.float64).reshape(-1, 2)
+    vertices[:, 4] *= -1  # flipY
+    if not skip_color:
+        colors = np.array([v[2] for v in flat], dtype=np.float64).reshape(-1, 3)
+        vertices[:, 5:8] = np.clip(colors, 0, 1)
+
+    # triangulate each surface as a fan around its first vertex
+    vertex_counts = np.array([len(surf['vertices']) for surf in surfaces], dtype=np.int64)
+    triangle_counts = np.maximum(vertex_counts - 2, 0)
+    first_vertices = np.cumsum(vertex_counts) - vertex_counts
+    first_triangles = np.cumsum(triangle_counts) - triangle_counts
+    fan_starts = np.repeat(first_vertices, triangle_counts)
+    fan_offsets = np.arange(triangle_counts.sum()) - \
+        np.repeat(first_triangles, triangle_counts)
+    indices = np.empty((len(fan_starts), 3), dtype=np.int64)
+    indices[:, 0] = fan_starts
+    indices[:, 1] = fan_starts + fan_offsets + 1
+    indices[:, 2] = fan_starts + fan_offsets + 2
+
+    # weld identical vertices (same position, uv and color), e.g. those shared by
+    # adjacent or twosided surfaces. they keep the order of their first occurrence
+    rows = vertices.view(np.dtype((np.void, vertices.itemsize * vertices.shape[1]))).reshape(-1)
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    remap = np.empty_like(order)
+    remap[order] = np.arange(len(order))
+    vertices = vertices[first[order]]
+    indices = remap[inverse.reshape(-1)][indices]
+
+    index_type = np.uint16 if len(vertices) < 65536 else np.uint32
+    return vertices, indices.reshape(-1).astype(index_type), bounds
+
+
+def _add_surfaces_to_gltf(gltf, *surface_sources, **kwargs):
+    mesh = pygltflib.Mesh()
+    skip_color = kwargs.get('skip_color', False)
+
+    material_to_surfaces = {}
+    for surfaces in surface_sources:
+        for surf in surfaces:
+            if not surf['material'] in material_to_surfaces:
+                material_to_surfaces[surf['material']] = []
+            material_to_surfaces[surf['material']].append(surf)
+
+    vertex_data = bytearray()
+    vertex_data_buffer_view = len(gltf.bufferViews)
+    total_vertex_count = 0
+    vertexByteLength = 4 * (3 + 2) + (0 if skip_color else 4 * 3)
+
+    index_data = bytearray()
+    index_data_buffer_view_index = len(gltf.bufferViews) + 1
+
+    for material, surfaces in material_to_surfaces.items():
+        vertex_data_buffer_offset = total_vertex_count * vertexByteLength
+        index_data.extend(b'\0' * (-len(index_data) % 4))  # align 32-bit indices
+        index_data_buffer_offset = len(index_data)
+
+        vertices, indices, bounds = _build_vertex_and_index_arrays(
+            surfaces, skip_color)
+        vertex_data.extend(vertices.tobytes())
+        index_data.extend(indices.tobytes())
+        vertex_count = len(vertices)
+        index_count = len(indices)
+
+        pos_accessor = pygltflib.Accessor(bufferView=vertex_data_buffer_view, byteOffset=vertex_data_buffer_offset, count=vertex_count,
+                                          componentType=pygltflib.FLOAT, type=pygltflib.VEC3, min=bounds[0], max=bounds[1])
+        uv_accessor = pygltflib.Accessor(bufferView=vertex_data_buffer_view, byteOffset=4*3+vertex_data_buffer_offset,
+                                         count=vertex_count, componentType=pygltflib.FLOAT, type=pygltflib.VEC2)
+        accessors = [len(gltf.accessors), len(gltf.accessors) + 1]
+        gltf.accessors.append(pos_accessor)
+        gltf.accessors.append(uv_accessor)
+        if not skip_color:
+            color_accessor = pygltflib.Accessor(bufferView=vertex_data_buffer_view, byteOffset=4*(
+                3+2)+vertex_data_buffer_offset, count=vertex_count, componentType=pygltflib.FLOAT, type=pygltflib.VEC3)
+            accessors.append(len(gltf.accessors))
+            gltf.accessors.append(color_accessor)
+
+        index_accessor = pygltflib.Accessor(bufferView=index_data_buffer_view_index, byteOffset=index_data_buffer_offset,
+                                            count=index_count, componentType=pygltflib.UNSIGNED_SHORT if indices.dtype == np.uint16 else pygltflib.UNSIGNED_INT,
+                                            type=pygltflib.SCALAR)
+        index_accessor_index = len(gltf.accessors)
+        gltf.accessors.append(index_accessor)
+
+        primitive = pygltflib.Primitive(
+            material=material, indices=index_accessor_index)
+        primitive.attributes.POSITION = accessors[0]
+        primitive.attributes.TEXCOORD_0 = accessors[1]
+        if not skip_color:
+            primitive.attributes.COLOR_0 = accessors[2]
+        mesh.primitives.append(primitive)
+
+        total_vertex_count += vertex_count
+
+    _add_buffer_view(gltf, vertex_data, byteStride=vertexByteLength,
+                     target=pygltflib.ARRAY_BUFFER)
+    _add_buffer_view(gltf, index_data, target=pygltflib.ELEMENT_ARRAY_BUFFER)
+
+    return mesh
+
+
+def _add_model_instances_to_gltf(gltf, model_instances):
+    # each model mesh is stored once and drawn at all of its placements with
+    # EXT_mesh_gpu_instancing; the lighting of a placement is its instance color
+    nodes = []
+    for group in model_instances:
+        mesh = _add_surfaces_to_gltf(gltf, group['surfaces'], skip_color=True)
+        attributes = {}
+        for attribute, name, accessor_type in [('TRANSLATION', 'translation', pygltflib.VEC3),
+                                               ('ROTATION', 'rotation', pygltflib.VEC4),
+                                               ('_COLOR_0', 'color', pygltflib.VEC3)]:
+            data = np.array([instance[name] for instance in group['instances']], dtype=np.float32)
+            accessor = pygltflib.Accessor(bufferView=_add_buffer_view(gltf, data.tobytes()), count=len(data),
+                                          componentType=pygltflib.FLOAT, type=accessor_type)
+            attributes[attribute] = len(gltf.accessors)
+            gltf.accessors.append(accessor)
+
+        node = pygltflib.Node(mesh=len(gltf.meshes), extensions={
+                              'EXT_mesh_gpu_instancing': {'attributes': attributes}})
+        nodes.append(len(gltf.nodes))
+        gltf.meshes.append(mesh)
+        gltf.nodes.append(node)
+
+    if nodes:
+        gltf.extensionsUsed.append('EXT_mesh_gpu_instancing')
+    return nodes
+
+
+def _cluster_sectors(sectors, sectors_per_node):
+    # grows clusters of connected sectors breadth first, so that the sectors of a
+    # cluster are close to each other and clusters are connected by portals
+    clusters = {}
+    cluster = -1
+    for start in sectors:
+        if start in clusters:
+            continue
+
+        cluster += 1
+        clusters[start] = cluster
+        size = 1
+        queue = collections.deque([start])
+        while queue and size < sectors_per_node:
+            for adjoin in sectors[queue.popleft()]['adjoins']:
+                if size < sectors_per_node and adjoin['sector'] not in clusters:
+                    clusters[adjoin['sector']] = cluster
+                    size += 1
+                    queue.append(adjoin['sector'])
+    return clusters
+
+
+def _add_sectors_to_gltf(gltf, surfaces, sectors, sectors_per_node):
+    # one node per cluster of sectors. their extras hold the bounds of the cluster
+    # and the portals to the other clusters, for the viewer to cull what can't be seen
+    clusters = _cluster_sectors(sectors, sectors_per_node)
+    cluster_sectors = {}
+    for key, cluster in clusters.items():
+        cluster_sectors.setdefault(cluster, []).append(key)
+    cluster_surfaces = {}
+    for surf in surfaces:
+        cluster_surfaces.setdefault(clusters[surf['sector']], []).append(surf)
+
+    nodes = []
+    for cluster, keys in cluster_sectors.items():
+        node = pygltflib.Node()
+        node.name = f'sectors_{cluster}'
+
+        bounds = [sectors[key]['bounds'] for key in keys if 'bounds' in sectors[key]]
+        if cluster in cluster_surfaces:
+            mesh = _add_surfaces_to_gltf(gltf, cluster_surfaces[cluster])
+            for primitive in mesh.primitives:
+                accessor = gltf.accessors[primitive.attributes.POSITION]
+                bounds.append([accessor.min, accessor.max])
+            node.mesh = len(gltf.meshes)
+            mesh.name = node.name
+            gltf.meshes.append(mesh)
+
+        adjoins = []
+        for key in keys:
+            for adjoin in sectors[key]['adjoins']:
+                if clusters[adjoin['sector']] != cluster:
+                    adjoins.append({'node': f'sectors_{clusters[adjoin["sector"]]}',
+                                    'vertices': adjoin['vertices']})
+
+        node.extras = {'sectors': keys, 'adjoins': adjoins}
+        if bounds:
+            bounds = np.array(bounds, dtype=np.float64)
+            node.extras['bounds'] = [bounds[:, 0].min(axis=0).tolist(),
+                                     bounds[:, 1].max(axis=0).tolist()]
+        nodes.append(len(gltf.nodes))
+        gltf.nodes.append(node)
+
+    return nodes
+
+
+def _get_max_geosets():
+    # the highest resolution geoset is shown up to the first distance, the next
+    # one up to the second distance and so on
+    return len(MODEL_LOD_DISTANCES) + 1 if MODEL_LOD_DISTANCES else 1
+
+
+def _add_lod_meshes_to_gltf(gltf, name, geoset_surfaces, skip_color=False):
+    # one mesh per geoset, shared by all placements of the model
+    meshes = []
+    for geoset, surfaces in enumerate(geoset_surfaces):
+        mesh = _add_surfaces_to_gltf(gltf, surfaces, skip_color=skip_color)
+        mesh.name = f'{name}_lod{geoset}'
+        meshes.append(len(gltf.meshes))
+        gltf.meshes.append(mesh)
+    return meshes
+
+
+def _add_lods_to_gltf(gltf, name, meshes, translation=None, rotation=None, color=None):
+    # three.js has no support for MSFT_lod, so the geosets are children of a
+    # node whose extras tell the viewer at which distance to switch to each of them.
+    # the lighting of a placement is the color of a single instance of each mesh
+    attributes = None
+    if color is not None:
+        data = np.array([color], dtype=np.float32)
+        accessor = pygltflib.Accessor(bufferView=_add_buffer_view(gltf, data.tobytes()), count=1,
+                                      componentType=pygltflib.FLOAT, type=pygltflib.VEC3)
+        attributes = {'_COLOR_0': len(gltf.accessors)}
+        gltf.accessors.append(accessor)
+        if 'EXT_mesh_gpu_instancing' not in gltf.extensionsUsed:
+            gltf.extensionsUsed.append('EXT_mesh_gpu_instancing')
+
+    children = []
+    for geoset, mesh in enumerate(meshes):
+        node = pygltflib.Node(mesh=mesh)
+        node.name = f'{name}_lod{geoset}'
+        if attributes:
+            node.extensions = {'EXT_mesh_gpu_instancing': {'attributes': attributes}}
+        children.append(len(gltf.nodes))
+        gltf.nodes.append(node)
+
+    node = pygltflib.Node(children=children, translation=translation, rotation=rotation, extras={
+                          'lod_distances': [0] + MODEL_LOD_DISTANCES[:len(children) - 1]})
+    node.name = name
+    gltf.nodes.append(node)
+    return len(gltf.nodes) - 1
+
+
+def build_level_glb(zip_path, levelname):
+    # returns the GLB and the textures that are not embedded in it, for the texture store
+    with gob.open_game_gobs_and_zip(zip_path) as vfs:
+        surfaces, model_surfaces, model_instances, model_lods, sky_surfaces, sectors, materials, _ = loader.load_level(
+            b'jkl/' + levelname, vfs, instancing=MODEL_INSTANCING, max_geosets=_get_max_geosets())
+
+    surface_sources = [surfaces, model_surfaces, sky_surfaces] + \
+        [group['surfaces'] for group in model_instances] + \
+        [geoset for lod in model_lods for geoset in lod['geosets']]
+    for src in surface_sources:
+        _normalize_uvs(src, materials)
+        _make_materials_for_translucent_surfaces(
+            src, materials)
+
+    if TEXTURE_ATLAS_SIZE:
+        # the sky is drawn with a shader of its own, so keep its textures
+        _pack_materials_into_atlases(
+            [surfaces, model_surfaces], surface_sources[2:], materials, TEXTURE_ATLAS_SIZE)
+
+    gltf = _new_gltf()
+    textures = {} if SEPARATE_MAP_TEXTURES or _use_texture_store() else None
+    _add_materials_to_gltf(gltf, materials, textures,
+                           separate=SEPARATE_MAP_TEXTURES)
+
+    if MAP_SECTORS_PER_NODE:
+        node = pygltflib.Node(children=_add_sectors_to_gltf(
+            gltf, surfaces + model_surfaces, sectors, MAP_SECTORS_PER_NODE))
+    else:
+        mesh = _add_surfaces_to_gltf(
+            gltf, surfaces, model_surfaces)
+        node = pygltflib.Node(mesh=len(gltf.meshes))
+        mesh.name = 'map'
+        gltf.meshes.append(mesh)
+    node.name = 'map'
+    nodes = [len(gltf.nodes)]
+    gltf.nodes.append(node)
+    node.children.extend(_add_model_instances_to_gltf(gltf, model_instances))
+    for i, lod in enumerate(model_lods):
+        meshes = _add_lod_meshes_to_gltf(
+            gltf, f'model_{i}', lod['geosets'], skip_color=True)
+        for j, instance in enumerate(lod['instances']):
+            node.children.append(_add_lods_to_gltf(
+                gltf, f'model_{i}_{j}', meshes, instance['translation'], instance['rotation'], instance['color']))
+
+    if sky_surfaces:
+        mesh = _add_surfaces_to_gltf(gltf, sky_surfaces)
+        sky_node = pygltflib.Node(mesh=len(gltf.meshes))
+        sky_node.name = mesh.name = 'sky'
+        nodes.append(len(gltf.nodes))
+        gltf.meshes.append(mesh)
+        gltf.nodes.append(sky_node)
+
+    scene = pygltflib.Scene(nodes=nodes)
+    gltf.scenes.append(scene)
+
+    return b"".join(gltf.save_to_bytes()), textures or {}
+
+
+def build_skins_glb(zip_path):
+    # returns the names of the skins, the GLB with one scene per skin and the
+    # textures that are not embedded in it
+    skins = []
+
+    # read the models.dat from the virtual file system
+    with gob.open_game_gobs_and_zip(zip_path) as vfs:
+        info = models.read_from_bytes(vfs.read(b'misc/models.dat'))
+        # Add single player models for MotS
+        info.models.append((b'kk.3do', 'Kyle Katarn'))
+        info.models.append((b'mj.3do', 'Mara Jade'))
+
+        # then locate models inside the archive
+        model_paths_and_names = [
+            m for m in info.models if vfs.zip_gobs.contains(b'3do/' + m[0])]
+        if len(model_paths_and_names) == 0:
+            # try to discover models in the gob
+            model_filename_pattern = re.compile(br'3do/(.+)\.3do')
+            for file in vfs.zip_gobs.ls():
+                match = model_filename_pattern.match(file)
+                if match:
+                    filename = match.group(1) + b'.3do'
+                    model_paths_and_names.append(
+                        (filename, filename.decode()))
+        if len(model_paths_and_names) == 0:
+            # probably just reskins Kyle
+            model_paths_and_names.append((b'ky.3do', 'Kyle Katarn'))
+
+        model_paths = [m[0] for m in model_paths_and_names]
+        surfaces, materials = loader.load_models(
+            model_paths, vfs, throw_on_error=DEVELOPMENT_MODE, max_geosets=_get_max_geosets())
+
+        for i, model in enumerate(model_paths_and_names):
+            if surfaces[i] is None:
+                continue
+
+            skins.append(model[1])
+            for geoset in surfaces[i]:
+                _normalize_uvs(geoset, materials)
+                _make_materials_for_translucent_surfaces(
+                    geoset, materials)
+
+        gltf = _new_gltf()
+        textures = {} if _use_texture_store() else None
+        _add_materials_to_gltf(gltf, materials, textures)
+
+        for i, model in enumerate(model_paths_and_names):
+            if len(surfaces[i]) > 1:
+                node_index = _add_lods_to_gltf(gltf, f'skin_{i}', _add_lod_meshes_to_gltf(
+                    gltf, f'skin_{i}', surfaces[i], skip_color=True))
+            else:
+                mesh = _add_surfaces_to_gltf(
+                    gltf, surfaces[i][0], skip_color=True)
+                node = pygltflib.Node(mesh=len(gltf.meshes))
+                node.name = mesh.name = f'skin_{i}'
+                node_index = len(gltf.nodes)
+                gltf.meshes.append(mesh)
+                gltf.nodes.append(node)
+
+            scene = pygltflib.Scene(nodes=[node_index])
+            gltf.scenes.append(scene)
+
+    return skins, b"".join(gltf.save_to_bytes()), textures or {}
@@ -1,3 +1,5 @@
+import collections
+import mmap
 import os
 import struct
 import sys
@@ -67,13 +69,46 @@ def open_gob_file(filename):
         raise
 
 
+class MappedGobFile(GobFile):
+    def __init__(self, mapping):
+        super().__init__(mapping)
+        self.view = memoryview(mapping)
+
+    def close(self):
+        pass  # the mapping is shared by all users in this process
+
+    def read(self, name):
+        name = name.lower()  # CASE INSENSITIVE
+        offset, length = self.toc[name]
+        return self.view[offset:offset + length]  # zero-copy
+
+
+_mapped_gob_files = {}
+
+
+def open_mapped_gob_file(filename):
+    # map each file only once per process and return read-only memoryviews into it
+    # so that concurrent extractions share the page cache instead of copying data
+    if filename not in _mapped_gob_files:
+        with open(filename, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            _mapped_gob_files[filename] = MappedGobFile(mapping)
+        except:
+            mapping.close()
+            raise
+    return _mapped_gob_files[filename]
+
+
 class MultiGob:
-    def __init__(self, gobs):
+    def __init__(self, gobs, fallback=None):
         toc = {}
         for gob in gobs:
             for filename in gob.ls():
                 toc[filename] = gob
-        self.toc = toc
+        # layer the entries on top of the fallback's table of contents (e.g., the
+        # official resources) without copying it
+        self.toc = collections.ChainMap(toc, fallback.toc) if fallback is not None else toc
 
     def ls(self):
         return self.toc.keys()
@@ -88,13 +123,13 @@ class MultiGob:
 
 
 class VirtualFileSystem:
-    def __init__(self, extra_handles, zip_gobs, official_gobs):
+    def __init__(self, extra_handles, zip_gobs, official_gobs=None):
         self.extra_handles = extra_handles
         self.zip_gobs = MultiGob(zip_gobs)
         # Order matters: let level specific gobs override official resources.
         # This is relevant, for example, for the Blue Rain level (375): it has its own 3do/tree.3do.
-        self.gobs = official_gobs + zip_gobs
-        self.multi_gob = MultiGob(self.gobs)
+        self.gobs = zip_gobs  # official gobs are shared and not closed
+        self.multi_gob = MultiGob(zip_gobs, fallback=official_gobs)
 
     def __enter__(self):
         return self
@@ -140,6 +175,24 @@ class ZipGob:
             return f.read()
 
 
+_official_gobs = None
+
+
+def open_official_gobs():
+    # the official resources are the same for every archive: index them only once
+    # per process and let each VirtualFileSystem layer its archive on top
+    global _official_gobs
+    if _official_gobs is None:
+        gobs = []
+        for filename in OFFICIAL:
+            try:
+                gobs.append(open_mapped_gob_file(filename))
+            except:
+                pass  # if not found, ignore it
+        _official_gobs = MultiGob(gobs)
+    return _official_gobs
+
+
 def _try_build_virtual_gob(zip_file):
     file_infos = {}
     for info in zip_file.infolist():
@@ -193,7 +246,7 @@ def _open_gobs_in_zip(zip_file):
                 open_files.append(zip_handle)
                 zip_gobs = _open_gobs_in_zip(zip_handle)
                 gobs.append(VirtualFileSystem(
-                    [zip_handle, zip_file_handle], zip_gobs, []))
+                    [zip_handle, zip_file_handle], zip_gobs))
 
         # some archives do not contains gobs, but rather files directly
         # detect such archives and allow access to the files via a virtual gob
@@ -214,7 +267,7 @@ def open_zip(zip_filename):
     zip_handle = zipfile.ZipFile(zip_filename)
     try:
         zip_gobs = _open_gobs_in_zip(zip_handle)
-        return VirtualFileSystem([zip_handle], zip_gobs, [])
+        return VirtualFileSystem([zip_handle], zip_gobs)
     except:
         zip_handle.close()
         raise
@@ -228,14 +281,7 @@ def open_game_gobs_and_zip(zip_filename):
         zip_handle.close()
         raise
 
-    official_gobs = []
-    for filename in OFFICIAL:
-        try:
-            official_gobs.append(open_gob_file(filename))
-        except:
-            pass  # if not found, ignore it
-
-    return VirtualFileSystem([zip_handle], zip_gobs, official_gobs)
+    return VirtualFileSystem([zip_handle], zip_gobs, open_official_gobs())
 
 
 if __name__ == "__main__":
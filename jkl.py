@@ -1,29 +1,17 @@
-import io
+import numpy as np
 import re
 
+COMMENT_RE = re.compile(br'#[^\n]*')  # # ...EOL
 SUBSECTION_RE = re.compile(br'(.+)\s+\d+\Z')  # [ITEM TYPE] [COUNT]EOL
 ITEM_RE = re.compile(br'(\d+):')  # [IDX]: ...
 CMP_RE = re.compile(br'(\d+):\s+(\S+)')  # [IDX]: [FILENAME]
+ADJOIN_RE = re.compile(br'(\d+):\s+0x([0-9a-fA-F]+)\s+(-?\d+)')  # [IDX]: [FLAGS] [MIRROR] ...
 # [IDX]: [FILENAME] 1 1
 FLOAT_FRAGMENT = r'-?\d*(?:\.\d+)?(?:[eE][-+]?\d+)?'
 VECTOR_RE = re.compile(
     fr'\(({FLOAT_FRAGMENT})/({FLOAT_FRAGMENT})/({FLOAT_FRAGMENT})\)'.encode())
 MATERIAL_RE = re.compile(
     fr'(\d+):\s+(\S+)\s+({FLOAT_FRAGMENT})\s+({FLOAT_FRAGMENT})'.encode())
-POSXYZ_RE = re.compile(
-    fr'(\d+):\s+({FLOAT_FRAGMENT})\s+({FLOAT_FRAGMENT})\s+({FLOAT_FRAGMENT})'.encode())  # [IDX]: [F] [F] [F]
-TEXUV_RE = re.compile(
-    fr'(\d+):\s+({FLOAT_FRAGMENT})\s+({FLOAT_FRAGMENT})'.encode())  # [IDX]: [F] [F]
-SURFACE_RE = re.compile(
-    fr'(\d+):\s+(\-?\d+)\s+(0x[0-9a-fA-F]+)\s+(0x[0-9a-fA-F]+)\s+(\-?\d+)\s+(\-?\d+)\s+(\-?\d+)\s+(\-?\d+)\s+({FLOAT_FRAGMENT})\s+(\-?\d+)'.encode())
-
-SECTOR_RE = re.compile(br'SECTOR\s+(\d+)')
-SECTOR_COLORMAP_RE = re.compile(br'COLORMAP\s+(\d+)')
-SECTOR_SURFACES_RE = re.compile(br'SURFACES\s+(\d+)\s+(\d+)')
-SECTOR_AMBIENT_LIGHT_RE = re.compile(
-    fr'AMBIENT\s+LIGHT\s+({FLOAT_FRAGMENT})'.encode())
-SECTOR_EXTRA_LIGHT_RE = re.compile(
-    fr'EXTRA\s+LIGHT\s+({FLOAT_FRAGMENT})'.encode())
 
 IDENTIFIER_FRAGMENT = r'[^0-9\s]\S+'
 TEMPLATE_RE = re.compile(fr'({IDENTIFIER_FRAGMENT})\s+({IDENTIFIER_FRAGMENT})\s+(\D.+)\Z'.encode())
@@ -31,15 +19,21 @@ THING_RE = re.compile(
     fr'(\d+):\s+({IDENTIFIER_FRAGMENT})\s+(\S+)\s+({FLOAT_FRAGMENT})\s+({FLOAT_FRAGMENT})\s+({FLOAT_FRAGMENT})\s+({FLOAT_FRAGMENT})\s+({FLOAT_FRAGMENT})\s+({FLOAT_FRAGMENT})\s+(-?\d+)(\s+-?\d+)?\s*(.*)'.encode())
 
 
-def _get_surface_rest_re(nverts, mots):
-    text = r'\s+'
-    text += r'(-?\d+),\s*(-?\d+)\s+' * nverts
-    if mots:
-        text += fr'({FLOAT_FRAGMENT})\s+' * nverts * 3
-    text += fr'({FLOAT_FRAGMENT})\s+' * (nverts - 1)
-    text += fr'({FLOAT_FRAGMENT})'  # no trailing whitespace
-    rest_re = re.compile(text.encode())
-    return rest_re
+def _read_vectors(lines, size):
+    # [IDX]: [F] ... [F], converted all at once into an array indexed by IDX
+    try:
+        table = np.array(b' '.join(lines).replace(b':', b' ').split(),
+                         dtype=np.float64).reshape(len(lines), size + 1)
+    except ValueError:
+        # some lines have more or fewer columns
+        table = np.array([[float(tokens[0][:-1])] + list(map(float, tokens[1:size + 1]))
+                          for tokens in map(bytes.split, lines) if len(tokens) > size],
+                         dtype=np.float64).reshape(-1, size + 1)
+
+    keys = table[:, 0].astype(np.int64)
+    vectors = np.full((keys.max() + 1 if len(keys) else 0, size), np.nan)
+    vectors[keys] = table[:, 1:]
+    return vectors
 
 
 def _parse_subsections(lines):
@@ -79,11 +73,13 @@ def _get_light_config(config):
 
 
 class JklFile:
-    def __init__(self, sections):
-        self._read_materials(sections[b'materials'])
-        self._read_georesource(sections[b'georesource'])
-        self._read_sectors(sections[b'sectors'])
-        self._prune_materials()
+    def __init__(self, sections, geometry=True):
+        if geometry:
+            self._read_materials(sections[b'materials'])
+            self._read_georesource(sections[b'georesource'])
+            self._read_sectors(sections[b'sectors'])
+            self._connect_sectors()
+            self._prune_materials()
 
         templates = self._read_templates(sections[b'templates'])
         self._read_things(sections[b'things'], templates)
@@ -113,100 +109,105 @@ class JklFile:
     def _read_georesource(self, lines):
         ss = _parse_subsections(lines)
 
-        xyzs = {}
-        for line in ss[b'world vertices']:
-            match = POSXYZ_RE.match(line)
-            if match:
-                key = int(match.group(1))
-                x = float(match.group(2))
-                y = float(match.group(3))
-                z = float(match.group(4))
-                xyzs[key] = (x, y, z)
-
-        uvs = {}
-        for line in ss[b'world texture vertices']:
-            match = TEXUV_RE.match(line)
-            if match:
-                key = int(match.group(1))
-                u = float(match.group(2))
-                v = float(match.group(3))
-                uvs[key] = (u, v)
+        xyzs = _read_vectors(ss[b'world vertices'], 3)
+        uvs = _read_vectors(ss[b'world texture vertices'], 2)
 
-        surfaces = {}
-        mots = True
-        for line in ss[b'world surfaces']:
-            match = SURFACE_RE.match(line)
+        adjoins = {}
+        for line in ss.get(b'world adjoins', []):
+            match = ADJOIN_RE.match(line)
             if match:
                 key = int(match.group(1))
-                mat = int(match.group(2))
-                surfflags = int(match.group(3)[2:], 16)
-                faceflags = int(match.group(4)[2:], 16)
-                geo = int(match.group(5))
-                light = int(match.group(6))
-                # tex = int(match.group(7))
-                # adjoin = int(match.group(8))
-                extra_light = float(match.group(9))
-                nverts = int(match.group(10))
-
-                rest = line[match.end(10):]
-
-                uv_scale = 0.5 if (surfflags & 0x10) else 1
-                uv_scale *= 2 if (surfflags & 0x20) else 1
-                uv_scale *= 8 if (surfflags & 0x40) else 1
-                ignore_lighting = (light == 1)
-                twosided = (faceflags & 0x1) != 0
-                translucent = (faceflags & 0x2) != 0
-
-                rest_re = _get_surface_rest_re(nverts, mots)
-                match = rest_re.match(rest)
-                if not match and mots:
-                    mots = False
-                    rest_re = _get_surface_rest_re(nverts, mots)
-                    match = rest_re.match(rest)
-
-                vertices = []
-                for i in range(nverts):
-                    xyz_idx = int(match.group(2 * i + 1))
-                    uv_idx = int(match.group(2 * i + 2))
-
-                    uv = (0.0, 0.0) if uv_idx == -1 \
-                        else (uvs[uv_idx][0] * uv_scale, uvs[uv_idx][1] * uv_scale)
-                    if ignore_lighting:
-                        diffuse = (1.0, 1.0, 1.0)
-                    elif mots:
-                        # TODO? l = float(match.group(2 * nverts + 4 * i + 1))
-                        r = float(match.group(2 * nverts + 4 * i + 2))
-                        g = float(match.group(2 * nverts + 4 * i + 3))
-                        b = float(match.group(2 * nverts + 4 * i + 4))
-                        r = min(1, r + extra_light)
-                        g = min(1, g + extra_light)
-                        b = min(1, b + extra_light)
-                        diffuse = (r, g, b)
-                    else:
-                        l = float(match.group(2 * nverts + i + 1))
-                        l = min(1, l + extra_light)
-                        diffuse = (l, l, l)
-                    vertices.append([xyzs[xyz_idx], uv, diffuse])
-
-                if twosided:
-                    vertices.extend(reversed(vertices[1:-1]))
-
-                surfaces[key] = {
-                    'vertices': vertices,
-                    'surfflags': surfflags,
-                    'geo': geo,
-                    'material': mat,
-                    'translucent': translucent
-                }
-
-            else:
-                match = POSXYZ_RE.match(line)  # normal vector
-                if match:
-                    key = int(match.group(1))
-                    x = float(match.group(2))
-                    y = float(match.group(3))
-                    z = float(match.group(4))
-                    surfaces[key]['normal'] = (x, y, z)
+                adjoins[key] = {'flags': int(match.group(2), 16),
+                                'mirror': int(match.group(3))}
+        self.adjoins = adjoins
+
+        # [IDX]: [MAT] [SURFFLAGS] [FACEFLAGS] [GEO] [LIGHT] [TEX] [ADJOIN] [EXTRALIGHT] [NVERTS] [V,UV]... [INTENSITY]...
+        # followed by the normal vectors of the surfaces: [IDX]: [X] [Y] [Z]
+        rows = [line.replace(b',', b' ').split() for line in ss[b'world surfaces']]
+        surface_rows = [tokens for tokens in rows if len(
+            tokens) > 10 and tokens[2].startswith(b'0x')]
+
+        # [NVERTS] and the header columns of all surfaces
+        surfflags = [int(tokens[2], 16) for tokens in surface_rows]
+        faceflags = [int(tokens[3], 16) for tokens in surface_rows]
+        nverts = np.array([tokens[9] for tokens in surface_rows], dtype=np.int64)
+        lengths = np.array([len(tokens) - 10 for tokens in surface_rows], dtype=np.int64)
+        lit = np.array([tokens[5] != b'1' for tokens in surface_rows], dtype=bool)
+        extra_lights = np.array([tokens[8] for tokens in surface_rows], dtype=np.float64)
+
+        # MotS levels have 4 intensities (l, r, g, b) per vertex, JK levels only 1, and
+        # the first surface with fewer of them tells that it's a JK level
+        mots = np.logical_and.accumulate(lengths >= 6 * nverts)
+
+        # as many vertices as there are complete (V, UV, INTENSITY...) columns
+        counts = np.minimum(nverts, lengths // 2)
+        jk = lit & ~mots
+        counts[jk] = np.minimum(counts[jk], np.maximum(0, lengths[jk] - 2 * nverts[jk]))
+
+        # pick the vertex columns out of all the tokens and convert them in one go, with
+        # rest where the columns after [NVERTS] of the vertex's surface start in flat and
+        # j the index of the vertex within its surface
+        flat = np.array([token for tokens in surface_rows for token in tokens[10:]], dtype=object)
+        surface_of = np.repeat(np.arange(len(counts)), counts)
+        starts = np.cumsum(lengths) - lengths
+        firsts = np.cumsum(counts) - counts
+        rest = starts[surface_of]
+        j = np.arange(len(surface_of)) - firsts[surface_of]
+
+        xyz_idxs = flat[rest + 2 * j].astype(np.int64)
+        uv_idxs = flat[rest + 2 * j + 1].astype(np.int64)
+
+        uv_scales = np.array([(0.5 if (f & 0x10) else 1) * (2 if (f & 0x20) else 1) * (8 if (f & 0x40) else 1)
+                              for f in surfflags], dtype=np.float64)
+        uv_array = np.zeros((len(uv_idxs), 2))
+        textured = uv_idxs != -1
+        uv_array[textured] = uvs[uv_idxs[textured]] * \
+            uv_scales[surface_of[textured], np.newaxis]
+
+        diffuse_array = np.ones((len(surface_of), 3))
+        jk_vertices = jk[surface_of]
+        diffuse_array[jk_vertices] = flat[(rest + 2 * nverts[surface_of] + j)[jk_vertices]].astype(
+            np.float64)[:, np.newaxis]
+        mots_vertices = (lit & mots)[surface_of]
+        # TODO? l = rest[2 * nverts::4]
+        mots_rgbs = (rest + 2 * nverts[surface_of] + 4 * j)[mots_vertices, np.newaxis] + np.arange(1, 4)
+        diffuse_array[mots_vertices] = flat[mots_rgbs].astype(np.float64)
+        lit_vertices = lit[surface_of]
+        diffuse_array[lit_vertices] = np.minimum(
+            diffuse_array[lit_vertices] + extra_lights[surface_of][lit_vertices, np.newaxis], 1)
+
+        # twosided surfaces repeat their inner vertices in reverse for the back side
+        twosided = np.array([(f & 0x1) != 0 for f in faceflags], dtype=bool)
+        sizes = counts + twosided * np.maximum(0, counts - 2)
+        ends = np.cumsum(sizes)
+        q = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - sizes, sizes)
+        count_of = np.repeat(counts, sizes)
+        order = np.repeat(firsts, sizes) + np.where(q < count_of, q, 2 * count_of - 2 - q)
+
+        # the vertices of a surface are a range in the level-wide vertex arrays:
+        # indices into the world vertices, texture coordinates and colors
+        self.vertices = xyzs
+        self.surface_vertices = {
+            'xyz': xyz_idxs[order],
+            'uvs': uv_array[order],
+            'colors': diffuse_array[order]
+        }
+        surfaces = {}
+        for tokens, surfflag, faceflag, first, last in zip(surface_rows, surfflags, faceflags,
+                                                          (ends - sizes).tolist(), ends.tolist()):
+            surfaces[int(tokens[0][:-1])] = {
+                'vertices': (first, last),
+                'surfflags': surfflag,
+                'geo': int(tokens[4]),
+                'adjoin': int(tokens[7]),
+                'material': int(tokens[1]),
+                'translucent': (faceflag & 0x2) != 0
+            }
+
+        for tokens in rows:
+            if len(tokens) > 3 and not (len(tokens) > 10 and tokens[2].startswith(b'0x')):
+                surfaces[int(tokens[0][:-1])]['normal'] = (
+                    float(tokens[1]), float(tokens[2]), float(tokens[3]))
 
         self.surfaces = surfaces
 
@@ -223,35 +224,50 @@ class JklFile:
 
         cur = None
         for line in lines:
-            match = SECTOR_RE.match(line)
-            if match:
-                key = int(match.group(1))
+            tokens = line.split()
+            keyword = tokens[0]
+            if keyword == b'SECTOR':
+                key = int(tokens[1])
                 sectors[key] = cur = {}
-                continue
-
-            match = SECTOR_COLORMAP_RE.match(line)
-            if match:
-                cur['colormap'] = int(match.group(1))
-                continue
-
-            match = SECTOR_SURFACES_RE.match(line)
-            if match:
-                first = int(match.group(1))
-                cur['surfaces'] = (first, first + int(match.group(2)))
-                continue
-
-            match = SECTOR_AMBIENT_LIGHT_RE.match(line)
-            if match:
-                cur['ambient_light'] = float(match.group(1))
-                continue
-
-            match = SECTOR_EXTRA_LIGHT_RE.match(line)
-            if match:
-                cur['extra_light'] = float(match.group(1))
-                continue
+            elif keyword == b'COLORMAP':
+                cur['colormap'] = int(tokens[1])
+            elif keyword == b'SURFACES':
+                first = int(tokens[1])
+                cur['surfaces'] = (first, first + int(tokens[2]))
+            elif keyword == b'AMBIENT' and tokens[1] == b'LIGHT':
+                cur['ambient_light'] = float(tokens[2])
+            elif keyword == b'EXTRA' and tokens[1] == b'LIGHT':
+                cur['extra_light'] = float(tokens[2])
+            elif keyword == b'BOUNDBOX':
+                bounds = tuple(map(float, tokens[1:7]))
+                cur['bounds'] = [bounds[0:3], bounds[3:6]]
 
         self.sectors = sectors
 
+    def _connect_sectors(self):
+        # two sectors are connected by a pair of surfaces whose adjoins mirror each other
+        surface_sectors = {}
+        adjoin_surfaces = {}
+        for key, sector in self.sectors.items():
+            for s in range(*sector['surfaces']):
+                surface_sectors[s] = key
+                if s in self.surfaces and self.surfaces[s]['adjoin'] != -1:
+                    adjoin_surfaces[self.surfaces[s]['adjoin']] = s
+
+        for key, sector in self.sectors.items():
+            sector['adjoins'] = []
+            for s in range(*sector['surfaces']):
+                try:
+                    mirror = self.adjoins[self.surfaces[s]['adjoin']]['mirror']
+                    other = surface_sectors[adjoin_surfaces[mirror]]
+                except KeyError:
+                    continue  # not an adjoin or a broken one
+
+                # the outline of the portal, without the back side of twosided surfaces
+                xyz = self.surface_vertices['xyz'][slice(*self.surfaces[s]['vertices'])]
+                vertices = list(map(tuple, self.vertices[list(dict.fromkeys(xyz.tolist()))].tolist()))
+                sector['adjoins'].append({'sector': other, 'vertices': vertices})
+
     def _read_config(self, text):
         config = {}
         for cfgpair in text.split():
@@ -323,36 +339,29 @@ def _strip(line):
     return line.strip()
 
 
-def _defines_section(line):
-    return len(line) > 8 and line[:8].lower() == b'section:'
-
-
-def _ends_section(line):
-    return line == b'end' or _defines_section(line)
-
-
-def _parse_section(lines, f):
-    for line in f:
-        line = _strip(line)
+def _split_sections(lines):
+    # split the stripped lines into their sections in a single pass
+    sections = {}
+    section_lines = None
+    for line in lines:
         if not line:
             continue
-        elif _ends_section(line):
-            return line
-        lines.append(line)
-    return b''
+        elif line[:8].lower() == b'section:' and len(line) > 8:
+            section = line[8:].strip().lower()
+            sections[section] = section_lines = []
+        elif line == b'end':
+            section_lines = None
+        elif section_lines is not None:
+            section_lines.append(line)
+    return sections
 
 
-def read_from_file(f):
-    sections = {}
-    for line in f:
-        line = _strip(line)
-        while _defines_section(line):
-            section = line[8:].strip().lower()
-            section_lines = []
-            line = _parse_section(section_lines, f)
-            sections[section] = section_lines
-    return JklFile(sections)
+def read_from_file(f, geometry=True):
+    return JklFile(_split_sections(map(_strip, f)), geometry)
 
 
-def read_from_bytes(b):
-    return read_from_file(io.BytesIO(b))
+def read_from_bytes(b, geometry=True):
+    # without geometry, only the things (lights, models and spawn points) are read
+    # drop all comments at once instead of line by line
+    lines = COMMENT_RE.sub(b'', bytes(b)).split(b'\n')
+    return JklFile(_split_sections(map(bytes.strip, lines)), geometry)
@@ -1,6 +1,15 @@
+import collections
+import hashlib
+import io
+import itertools
+import logging
 import math
+import numpy as np
+import os
+import pickle
+import tempfile
+import threading
 import transformations as tf
-import io
 
 import cmp
 import jkl
@@ -10,6 +19,8 @@ import threedo
 
 FALLBACK_MATERIAL_FULL_NAME = b'mat/dflt.mat'
 
+_logger = logging.getLogger(__name__)
+
 
 def _make_material_from_frames(frames):
     # find the average color of the pixels
@@ -29,6 +40,166 @@ def _make_material_from_frames(frames):
     return {'color': color, 'image': image, 'mime': mime, 'dims': dims}
 
 
+class ContentCache:
+    # process-wide LRU cache of objects derived from file contents and keyed by their
+    # hash, so that e.g. materials and models used by many levels (the official ones)
+    # are only processed once; optionally backed by files in a directory to survive restarts,
+    # of which the least recently used are removed when they exceed max_disk_bytes
+    def __init__(self, max_bytes, size_of, extension, directory=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.extension = extension
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.disk_bytes = None  # unknown until the directory is scanned
+        self.disk_lock = threading.Lock()
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, '{}.{}'.format(key, self.extension))
+
+    def _insert(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = value
+            self.total_bytes += self.size_of(value)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= self.size_of(evicted)
+
+    def _prune_directory(self):
+        # other processes share the directory, so look at what is actually there and
+        # remove the files used longest ago, down to 90% of the budget to not rescan
+        # on every put
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.' + self.extension):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # removed in the meantime
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_bytes <= self.max_disk_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # removed by another process
+            total_bytes -= size
+        self.disk_bytes = total_bytes
+
+    def _add_to_directory(self, size):
+        if self.max_disk_bytes is None:
+            return
+        with self.disk_lock:
+            if self.disk_bytes is not None:
+                self.disk_bytes += size
+            if self.disk_bytes is None or self.disk_bytes > self.max_disk_bytes:
+                self._prune_directory()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                return value
+
+        if self.directory:
+            try:
+                path = self._get_path(key)
+                with open(path, 'rb') as f:
+                    value = pickle.load(f)
+                os.utime(path)  # mark as recently used
+                self._insert(key, value)
+                return value
+            except:
+                pass  # not stored or unreadable, process again
+        return None
+
+    def put(self, key, value):
+        self._insert(key, value)
+
+        if self.directory:
+            try:
+                with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as tmp_file:
+                    try:
+                        pickle.dump(value, tmp_file, pickle.HIGHEST_PROTOCOL)
+                        size = tmp_file.tell()
+                        tmp_file.close()
+                        os.replace(tmp_file.name, self._get_path(key))
+                    except:
+                        os.remove(tmp_file.name)
+                        raise
+                self._add_to_directory(size)
+            except (OSError, pickle.PickleError):
+                # the directory is only a second level: e.g. a full disk must not fail
+                # the level, whose value is still cached in memory
+                _logger.warning('could not store %s.%s in %s', key,
+                                self.extension, self.directory, exc_info=True)
+
+
+def _get_material_size(material):
+    return len(material['image'])
+
+
+def _get_model_size(model):
+    # rough size of the parsed model in memory, dominated by its vertices
+    return 512 * sum(len(surface['vertices']) for geoset in model.geosets for mesh in geoset.values() for surface in mesh.values())
+
+
+decoded_material_cache = ContentCache(
+    64 * 1024 * 1024, _get_material_size, 'material')
+parsed_model_cache = ContentCache(
+    16 * 1024 * 1024, _get_model_size, 'model')
+
+
+def configure_decoded_material_cache(max_bytes, directory=None, max_disk_bytes=None):
+    global decoded_material_cache
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    decoded_material_cache = ContentCache(
+        max_bytes, _get_material_size, 'material', directory, max_disk_bytes)
+
+
+def configure_parsed_model_cache(max_bytes, directory=None, max_disk_bytes=None):
+    global parsed_model_cache
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    parsed_model_cache = ContentCache(
+        max_bytes, _get_model_size, 'model', directory, max_disk_bytes)
+
+
+def _parse_model(data):
+    key = hashlib.sha1(data).hexdigest()
+    model = parsed_model_cache.get(key)
+    if model is None:
+        model = threedo.read_from_bytes(data)
+        parsed_model_cache.put(key, model)
+    return model  # shared, so it must not be modified
+
+
+def _hash_colormap(colormap):
+    if not colormap:
+        return 'none'
+    return hashlib.sha1(bytes(itertools.chain.from_iterable(colormap))).hexdigest()
+
+
+def _decode_material(data, colormap, colormap_hash):
+    key = '{}-{}'.format(hashlib.sha1(data).hexdigest(), colormap_hash)
+    material = decoded_material_cache.get(key)
+    if material is None:
+        frames = mat.load_frames_from_bytes(data, colormap=colormap)
+        material = _make_material_from_frames(frames)
+        decoded_material_cache.put(key, material)
+    return dict(material)  # callers modify their materials, don't share them
+
+
 class MaterialCache:
     def __init__(self, vfs):
         self.vfs = vfs
@@ -36,10 +207,12 @@ class MaterialCache:
         self.cache = {}
         self.colormap_name = ''
         self.colormap = None
+        self.colormap_hash = _hash_colormap(None)
 
     def set_current_colormap(self, colormap_name, colormap):
         self.colormap_name = colormap_name
         self.colormap = colormap
+        self.colormap_hash = _hash_colormap(colormap)
 
     def load(self, material_name):
         material_key = '{}_{}'.format(material_name, self.colormap_name)
@@ -49,12 +222,11 @@ class MaterialCache:
                 try:
                     material_full_name = prefix + b'/' + material_name
                     try:
-                        frames = mat.load_frames_from_bytes(
-                            self.vfs.read(material_full_name), colormap=self.colormap)
+                        material = _decode_material(self.vfs.read(
+                            material_full_name), self.colormap, self.colormap_hash)
                     except ValueError:
-                        frames = mat.load_frames_from_bytes(
-                            self.vfs.read(FALLBACK_MATERIAL_FULL_NAME), colormap=self.colormap)
-                    material = _make_material_from_frames(frames)
+                        material = _decode_material(self.vfs.read(
+                            FALLBACK_MATERIAL_FULL_NAME), self.colormap, self.colormap_hash)
                     material['name'] = material_full_name
                 except KeyError:
                     pass
@@ -65,57 +237,114 @@ class MaterialCache:
         return self.cache[material_key]
 
 
-def _transform_vector(m, v, w):
-    x = m[0][0] * v[0] + m[0][1] * v[1] + m[0][2] * v[2] + m[0][3] * w
-    y = m[1][0] * v[0] + m[1][1] * v[1] + m[1][2] * v[2] + m[1][3] * w
-    z = m[2][0] * v[0] + m[2][1] * v[1] + m[2][2] * v[2] + m[2][3] * w
-    return (float(x), float(y), float(z))
-
-
 def _transform_vertices(transform, vertices):
-    ret = []
-    for v in vertices:
-        pos = _transform_vector(transform, v[0], 1.0)
-        norm = _transform_vector(transform, v[3], 0.0)
-        ret.append([pos, v[1], v[2], norm])
-    return ret
-
-
-def _add_light(v, l):
-    return [
-        v[0],
-        v[1],
-        (min(1, v[2][0] + l), min(1, v[2][1] + l), min(1, v[2][2] + l))
-    ]
-
-
-def _normalize_vector(v):
-    length = math.sqrt(v[0] * v[0] + v[1] * v[1] + v[2] * v[2])
-    if length == 0:
-        return v
-    il = 1.0 / length
-    return (v[0] * il, v[1] * il, v[2] * il)
-
-
-def _apply_lighting(v, sector, lights):
-    pos = v[0]
-    n = _normalize_vector(v[3])
-    total = sector.get('ambient_light', 0) if sector else 0
-    for light in lights:
-        lpos = (light['pos'][0] + light['offset'][0], light['pos'][1] +
-                light['offset'][1], light['pos'][2] + light['offset'][2])
-        l = (lpos[0] - pos[0], lpos[1] - pos[1], lpos[2] - pos[2])
-        distance = math.sqrt(l[0] * l[0] + l[1] * l[1] + l[2] * l[2])
+    # transforms the positions and normals of the vertices with one matrix multiply
+    # each, returns them as Nx3 arrays
+    points = np.empty((len(vertices), 4))
+    points[:, 0:3] = [v[0] for v in vertices]
+    points[:, 3] = 1.0
+    directions = np.zeros((len(vertices), 4))
+    directions[:, 0:3] = [v[3] for v in vertices]
+    m = np.asarray(transform)[0:3].T
+    return points @ m, directions @ m
+
+
+def _make_level_vertices(level, surfaces, extra_lights):
+    # the vertices of many level surfaces, lit by the extra light of their sectors
+    counts = [surface['vertices'][1] - surface['vertices'][0] for surface in surfaces]
+    idxs = [i for surface in surfaces for i in range(*surface['vertices'])]
+    arrays = level.surface_vertices
+
+    positions = list(map(tuple, level.vertices.tolist()))
+    xyz = arrays['xyz'][idxs].tolist()
+    uvs = arrays['uvs'][idxs].reshape(-1, 2)
+    colors = np.minimum(1, arrays['colors'][idxs].reshape(-1, 3) +
+                        np.repeat(np.array(extra_lights, dtype=np.float64), counts)[:, np.newaxis])
+    flat = list(map(list, zip([positions[i] for i in xyz],
+                              map(tuple, uvs.tolist()), map(tuple, colors.tolist()))))
+
+    vertices = []
+    first = 0
+    for count in counts:
+        vertices.append(flat[first:first + count])
+        first += count
+    return vertices
+
+
+def _make_light_arrays(lights):
+    # the lights of a level as arrays, for lighting many vertices at once
+    arrays = {
+        'pos': np.array([[light['pos'][i] + light['offset'][i] for i in range(3)] for light in lights],
+                        dtype=np.float64).reshape(-1, 3),
         # range from https://forums.massassi.net/Editing_Forums/Jedi_Knight_and_Mysteries_of_the_Sith_Editing_Forum/thread_30544_page_1.html
-        range = light['intensity'] * 1.25 * 2
-        if distance >= range:
-            continue
-        ndotl = (n[0] * l[0] + n[1] * l[1] + n[2]
-                 * l[2]) / distance  # normalize l
-        if ndotl > 0:
-            total += ndotl * (1 - distance / range) * light['light']
+        'range': np.array([light['intensity'] * 1.25 * 2 for light in lights], dtype=np.float64),
+        'light': np.array([light['light'] for light in lights], dtype=np.float64),
+    }
+
+    # put the lights into a uniform grid of cells as big as the largest range, so
+    # that only the lights in neighboring cells can reach something in a cell
+    arrays['cell_size'] = max(float(arrays['range'].max()), 1.0) if lights else 1.0
+    cells = collections.defaultdict(list)
+    for i, cell in enumerate(np.floor(arrays['pos'] / arrays['cell_size']).astype(np.int64).tolist()):
+        cells[tuple(cell)].append(i)
+    arrays['cells'] = cells
+    return arrays
+
+
+def _find_lights(lights, center, radius):
+    # returns the lights that may reach something within the sphere
+    if not lights['cells']:
+        return lights
+
+    cell_size = lights['cell_size']
+    lo = np.floor((center - radius - cell_size) / cell_size).astype(np.int64)
+    hi = np.floor((center + radius + cell_size) / cell_size).astype(np.int64)
+    if np.prod(hi - lo + 1) > len(lights['cells']):
+        # the sphere is huge: visit the cells with lights instead
+        candidates = [i for cell, indices in lights['cells'].items()
+                      if all(lo[a] <= cell[a] <= hi[a] for a in range(3)) for i in indices]
+    else:
+        candidates = []
+        for x in range(lo[0], hi[0] + 1):
+            for y in range(lo[1], hi[1] + 1):
+                for z in range(lo[2], hi[2] + 1):
+                    candidates.extend(lights['cells'].get((x, y, z), ()))
+    candidates.sort()  # keep the order of the lights
+
+    indices = np.array(candidates, dtype=np.int64)
+    d = lights['pos'][indices] - center
+    reach = np.sqrt((d * d).sum(axis=1)) < lights['range'][indices] + radius
+    indices = indices[reach]
+    return {'pos': lights['pos'][indices], 'range': lights['range'][indices], 'light': lights['light'][indices]}
+
+
+def _compute_lighting(positions, normals, sector, lights):
+    # returns the light that reaches each vertex as an array, computed for all
+    # vertices and those lights at once that can reach the bounding sphere of the vertices
+    total = np.full(len(positions), sector.get(
+        'ambient_light', 0) if sector else 0, dtype=np.float64)
+
+    if len(lights['range']):
+        center = (positions.min(axis=0) + positions.max(axis=0)) * 0.5
+        offsets = positions - center
+        radius = np.sqrt((offsets * offsets).sum(axis=1)).max()
+        lights = _find_lights(lights, center, radius)
+
+    if len(lights['range']):
+        lengths = np.sqrt((normals * normals).sum(axis=1))
+        n = normals / np.where(lengths == 0, 1, lengths)[:, np.newaxis]
+
+        l = lights['pos'][np.newaxis, :, :] - positions[:, np.newaxis, :]
+        distance = np.sqrt((l * l).sum(axis=2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ndotl = (n[:, np.newaxis, :] * l).sum(axis=2) / \
+                distance  # normalize l
+            contribution = ndotl * (1 - distance / lights['range']) * lights['light']
+        reached = (distance < lights['range']) & (ndotl > 0)
+        total += np.where(reached, contribution, 0).sum(axis=1)
+
     extra_light = sector.get('extra_light', 0) if sector else 0
-    return _add_light(v, total + extra_light)
+    return total + extra_light
 
 
 def _rotation_matrix(rot):
@@ -123,7 +352,23 @@ def _rotation_matrix(rot):
     return tf.euler_matrix(rot[2], rot[1], rot[0], 'ryzx')
 
 
-def _instantiate_node(surfaces, model, node, transform, sector, lights, texcache):
+# placements of a model mesh whose lighting varies by less than this are drawn as
+# instances of a single mesh with a color per instance
+INSTANCE_LIGHT_TOLERANCE = 1.0 / 64
+
+
+def _get_mesh_surfaces(model, mesh_index, geoset=0):
+    mesh_surfaces = []
+    for _, surface in model.geosets[geoset].get(mesh_index, {}).items():
+        try:
+            material_name = model.materials[surface['material']]
+        except:
+            continue  # if there's no material, don't render the surface
+        mesh_surfaces.append((surface, material_name))
+    return mesh_surfaces
+
+
+def _instantiate_node(surfaces, model, node, transform, sector, lights, texcache, placements=None, geoset=0):
     rot = node['rot']
     transform = tf.concatenate_matrices(
         transform, tf.translation_matrix(node['offset']), _rotation_matrix(rot))
@@ -131,37 +376,116 @@ def _instantiate_node(surfaces, model, node, transform, sector, lights, texcache
     if node['mesh'] != -1:
         mesh_transform = tf.concatenate_matrices(
             transform, tf.translation_matrix(node['pivot']))
-        mesh = model.meshes[node['mesh']]
-        for _, surface in mesh.items():
-            try:
-                material_name = model.materials[surface['material']]
-            except:
-                continue  # if there's no material, don't render the surface
-
-            vertices = _transform_vertices(mesh_transform, surface['vertices'])
-            vertices = [_apply_lighting(v, sector, lights) for v in vertices]
-            surfaces.append({
-                'vertices': vertices,
+        mesh_surfaces = _get_mesh_surfaces(model, node['mesh'], geoset)
+
+        # transform and light the vertices of all surfaces of the mesh in one go
+        vertices = [v for surface, _ in mesh_surfaces for v in surface['vertices']]
+        if vertices:
+            positions, normals = _transform_vertices(mesh_transform, vertices)
+            light = _compute_lighting(positions, normals, sector, lights)
+            colors = np.minimum(
+                1, np.array([v[2] for v in vertices], dtype=np.float64) + light[:, np.newaxis])
+            color = colors.mean(axis=0)
+            uniform = np.abs(colors - color).max() <= INSTANCE_LIGHT_TOLERANCE
+            positions = positions.tolist()
+            colors = colors.tolist()
+
+        baked_surfaces = []
+        first = 0
+        for surface, material_name in mesh_surfaces:
+            last = first + len(surface['vertices'])
+            baked_surfaces.append({
+                'vertices': [[positions[i], vertices[i][1], colors[i]] for i in range(first, last)],
                 'material': texcache.load(material_name),
                 'translucent': surface['translucent']
             })
+            first = last
+
+        if placements is not None and vertices and uniform:
+            # load_level decides whether to bake it or to make it an instance
+            placements.append({'model': model, 'mesh': node['mesh'], 'transform': mesh_transform,
+                               'color': color.tolist(), 'surfaces': baked_surfaces})
+        else:
+            surfaces.extend(baked_surfaces)
 
     for child in node['children']:
         _instantiate_node(surfaces, model, child, transform,
-                          sector, lights, texcache)
+                          sector, lights, texcache, placements, geoset)
 
 
-def _instantiate_model(model, pos, rot, sector, lights, texcache):
+def _instantiate_model(model, pos, rot, sector, lights, texcache, placements=None, geoset=0):
     surfaces = []
     transform = tf.concatenate_matrices(tf.translation_matrix(
         pos), _rotation_matrix(rot))
     for root_node in model.root_nodes:
         _instantiate_node(surfaces, model, root_node,
-                          transform, sector, lights, texcache)
+                          transform, sector, lights, texcache, placements, geoset)
     return surfaces
 
 
-def load_level(jkl_name, vfs):
+def _make_model_lods(model, texcache, max_geosets):
+    # the surfaces of each geoset in model space, shared by all placements of the
+    # model. like instances, they are lit by the color of the placement
+    geosets = []
+    for geoset in range(min(len(model.geosets), max_geosets)):
+        surfaces = _instantiate_model(
+            model, (0, 0, 0), (0, 0, 0), None, _make_light_arrays([]), texcache, geoset=geoset)
+        for surface in surfaces:
+            for v in surface['vertices']:
+                v[2] = (1.0, 1.0, 1.0)
+        geosets.append(surfaces)
+    return {'geosets': geosets, 'instances': []}
+
+
+def _make_model_lod_instance(surfaces, pos, rot):
+    # returns the transform and color of a placement if it is lit uniformly enough
+    # to be drawn with the shared geosets, None otherwise
+    colors = np.array([v[2] for surface in surfaces for v in surface['vertices']], dtype=np.float64)
+    if not len(colors):
+        return None
+    color = colors.mean(axis=0)
+    if np.abs(colors - color).max() > INSTANCE_LIGHT_TOLERANCE:
+        return None
+    w, x, y, z = tf.quaternion_from_matrix(_rotation_matrix(rot))
+    return {'translation': list(pos), 'rotation': [x, y, z, w], 'color': color.tolist()}
+
+
+def _make_model_instances(placements, texcache):
+    # groups the placements by model mesh. meshes placed more than once are returned
+    # in model space with the transforms and colors of their instances, the surfaces
+    # of the others are returned baked
+    groups = {}
+    for placement in placements:
+        key = (id(placement['model']), placement['mesh'])
+        groups.setdefault(key, []).append(placement)
+
+    model_instances = []
+    baked_surfaces = []
+    for group in groups.values():
+        if len(group) < 2:
+            baked_surfaces.extend(group[0]['surfaces'])
+            continue
+
+        surfaces = []
+        for surface, material_name in _get_mesh_surfaces(group[0]['model'], group[0]['mesh']):
+            surfaces.append({
+                'vertices': [[v[0], v[1], (1.0, 1.0, 1.0)] for v in surface['vertices']],
+                'material': texcache.load(material_name),
+                'translucent': surface['translucent']
+            })
+
+        instances = []
+        for placement in group:
+            w, x, y, z = tf.quaternion_from_matrix(placement['transform'])
+            instances.append({'translation': tf.translation_from_matrix(placement['transform']).tolist(),
+                              'rotation': [x, y, z, w], 'color': placement['color']})
+        model_instances.append(
+            {'surfaces': surfaces, 'instances': instances})
+
+    return model_instances, baked_surfaces
+
+
+def load_level(jkl_name, vfs, instancing=False, max_geosets=1):
     surfaces = []
     sky_surfaces = []
 
@@ -191,7 +515,8 @@ def load_level(jkl_name, vfs):
         pass  # failed to load level master colormap
 
     # load sectors
-    for _, sector in level.sectors.items():
+    sector_surfaces = []
+    for key, sector in level.sectors.items():
         for s in range(sector['surfaces'][0], sector['surfaces'][1]):
             surface = level.surfaces[s]
             if surface['geo'] != 4:
@@ -202,29 +527,38 @@ def load_level(jkl_name, vfs):
             except:
                 continue  # if there's no material, don't render the surface
 
-            vertices = [_add_light(v, sector.get('extra_light', 0))
-                        for v in surface['vertices']]
             surface_data = {
-                'vertices': vertices,
+                'vertices': None,  # filled in below for all surfaces at once
                 'material': texcache.load(material_name),
-                'translucent': surface['translucent']
+                'translucent': surface['translucent'],
+                'sector': key
             }
 
             if surface['surfflags'] & 0x600:  # horizon or ceiling
                 sky_surfaces.append(surface_data)  # horizon
             else:
                 surfaces.append(surface_data)
+            sector_surfaces.append(
+                (surface, sector.get('extra_light', 0), surface_data))
+
+    # then build the vertices of all of them in one go
+    vertices = _make_level_vertices(level, [surface for surface, _, _ in sector_surfaces],
+                                    [extra_light for _, extra_light, _ in sector_surfaces])
+    for (_, _, surface_data), surface_vertices in zip(sector_surfaces, vertices):
+        surface_data['vertices'] = surface_vertices
 
     # load models and instantiate them in the scene
+    lights = _make_light_arrays(level.lights)
     models = {}
     model_surfaces = []
+    placements = [] if instancing else None
+    model_lods = {}
     for instance in level.models:
         filename = instance['model']
         if not filename in models:
             full_filename = b'3do/' + filename
             try:
-                models[filename] = threedo.read_from_bytes(
-                    vfs.read(full_filename))
+                models[filename] = _parse_model(vfs.read(full_filename))
             except:
                 continue  # model not found
 
@@ -232,14 +566,46 @@ def load_level(jkl_name, vfs):
             sector = level.sectors[instance['sector']]
         except KeyError:
             continue
+        if max_geosets > 1 and len(models[filename].geosets) > 1:
+            # switches between its geosets by distance, unless the lighting varies
+            # too much across the model. then its first geoset is baked
+            model = _instantiate_model(
+                models[filename], instance['pos'], instance['rot'], sector, lights, texcache)
+            lod_instance = _make_model_lod_instance(model, instance['pos'], instance['rot'])
+            if lod_instance is not None:
+                if filename not in model_lods:
+                    model_lods[filename] = _make_model_lods(
+                        models[filename], texcache, max_geosets)
+                model_lods[filename]['instances'].append(lod_instance)
+                continue
+
+            model_surfaces.extend(model)
+            for surface in model:
+                surface['sector'] = instance['sector']
+            continue
+
+        first_placement = len(placements) if instancing else 0
         model = _instantiate_model(
-            models[filename], instance['pos'], instance['rot'], sector, level.lights, texcache)
+            models[filename], instance['pos'], instance['rot'], sector, lights, texcache, placements)
         model_surfaces.extend(model)
 
-    return surfaces, model_surfaces, sky_surfaces, texcache.materials, level.spawn_points
+        # remember the sector of the surfaces, including those that may be baked later
+        if instancing:
+            model = model + [surface for placement in placements[first_placement:]
+                             for surface in placement['surfaces']]
+        for surface in model:
+            surface['sector'] = instance['sector']
+
+    model_instances = []
+    if instancing:
+        model_instances, baked_surfaces = _make_model_instances(
+            placements, texcache)
+        model_surfaces.extend(baked_surfaces)
+
+    return surfaces, model_surfaces, model_instances, list(model_lods.values()), sky_surfaces, level.sectors, texcache.materials, level.spawn_points
 
 
-def load_models(model_paths, vfs, throw_on_error=False):
+def load_models(model_paths, vfs, throw_on_error=False, max_geosets=1):
     models = []
 
     texcache = MaterialCache(vfs)
@@ -254,13 +620,13 @@ def load_models(model_paths, vfs, throw_on_error=False):
     pos = (0, 0, 0)
     rot = (0, 0, 0)
     sector = None
-    lights = []
+    lights = _make_light_arrays([])
     for filename in model_paths:
         try:
             full_filename = b'3do/' + filename
-            model_threedo = threedo.read_from_bytes(vfs.read(full_filename))
-            models.append(_instantiate_model(
-                model_threedo, pos, rot, sector, lights, texcache))
+            model_threedo = _parse_model(vfs.read(full_filename))
+            models.append([_instantiate_model(model_threedo, pos, rot, sector, lights, texcache, geoset=geoset)
+                           for geoset in range(min(len(model_threedo.geosets), max_geosets))])
         except:
             if throw_on_error: raise
             models.append(None)  # model not found
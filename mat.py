@@ -1,5 +1,6 @@
 import io
 import itertools
+import numpy as np
 import os
 import struct
 import sys
@@ -8,19 +9,19 @@ from PIL import Image, ImageOps
 
 
 def _decode_16bit(data, color_extraction):
-    sr, sg, sb = [x for x in color_extraction['channel_shifts']]
-    mr, mg, mb = [(1 << bits) - 1 for bits in color_extraction['channel_bits']]
-    er, eg, eb = [x for x in color_extraction['channel_expands']]
+    shifts = np.array(color_extraction['channel_shifts'], dtype=np.uint32)
+    masks = np.array([(1 << bits) - 1 for bits in color_extraction['channel_bits']], dtype=np.uint32)
+    expands = np.array(color_extraction['channel_expands'], dtype=np.uint32)
 
-    colors = []
-    for i in range(0, len(data), 2):
-        val = data[i] | (data[i + 1] << 8)
-        r = ((val >> sr) & mr) << er
-        g = ((val >> sg) & mg) << eg
-        b = ((val >> sb) & mb) << eb
-        a = 255
-        colors.append((r, g, b, a))
-    return colors
+    # extract and expand the r, g, b channels of all little-endian pixels at once
+    values = np.frombuffer(data, dtype='<u2').astype(np.uint32)
+    channels = ((values[:, np.newaxis] >> shifts) & masks) << expands
+    if channels.size and channels.max() > 255:
+        raise ValueError("Invalid color extraction!")
+
+    pixels = np.full((len(values), 4), 255, dtype=np.uint8)
+    pixels[:, 0:3] = channels
+    return pixels.tobytes()
 
 
 def _read_colors(f, color_extraction, count, colormap):
@@ -44,11 +45,35 @@ def _read_colors(f, color_extraction, count, colormap):
     return frames
 
 
-def _set_alpha(rgba, lhs, rhs):
-    return (rgba[0], rgba[1], rgba[2], 0) if lhs == rhs else rgba
+def _make_palette(colormap):
+    # 256 colors in RGBA order; without a colormap, use the color index as gray value
+    if colormap:
+        return np.array(colormap, dtype=np.uint8)
+    gray = np.arange(256, dtype=np.uint8)
+    return np.stack([gray, gray, gray, np.full(256, 255, dtype=np.uint8)], axis=1)
+
+
+def _decode_8bit(data, palette, transparent_color):
+    if 0 <= transparent_color < len(palette):
+        palette = palette.copy()
+        palette[transparent_color, 3] = 0
+    # look up whole RGBA pixels at once by viewing each palette entry as one uint32
+    rgba = palette.view(np.uint32).reshape(-1)
+    return rgba[np.frombuffer(data, dtype=np.uint8)].tobytes()
+
 
+def _get_mipmap_dims(width, height, mipmaps):
+    dims = []
+    for _ in range(mipmaps):
+        dims.append((width, height))
+        if width != 1:
+            width //= 2
+        if height != 1:
+            height //= 2
+    return dims
 
-def _read_textures(f, color_extraction, count, colormap):
+
+def _read_textures(f, color_extraction, count, colormap, mip_level):
     # load the headers
     for i in range(count):
         mat_type, transparent_color, res1, res2, res3, res4, res5, res6, res7, idx = struct.unpack(
@@ -56,55 +81,43 @@ def _read_textures(f, color_extraction, count, colormap):
         if mat_type != 8 or idx != i:
             raise Exception("Not a texture!")
 
+    if color_extraction['total_bits'] not in (8, 16):
+        raise Exception("Invalid file!")
+    pixel_size = color_extraction['total_bits'] // 8
+
     # load the data
+    palette = _make_palette(colormap) if pixel_size == 1 else None
     frames = []
     for i in range(count):
         width, height, has_transparency, res2, res3, mipmaps = struct.unpack(
             'iiiiii', f.read(24))
+        if mipmaps < 1:
+            raise Exception("Invalid file!")
 
         ts = transparent_color if has_transparency else -1
 
-        pixel_bytes = None
-        org_width = width
-        org_height = height
-        for j in range(mipmaps):
-            if color_extraction['total_bits'] == 8:
-                data = f.read(width * height)
-                if j == 0:  # only load first mipmap
-                    if has_transparency:
-                        if colormap:
-                            pixel_bytes = [_set_alpha(
-                                colormap[i], i, ts) for i in data]
-                        else:
-                            pixel_bytes = [_set_alpha(
-                                (i, i, i, 255), i, ts) for i in data]
-                    else:
-                        if colormap:
-                            pixel_bytes = [colormap[i] for i in data]
-                        else:
-                            pixel_bytes = [(i, i, i, 255) for i in data]
-            elif color_extraction['total_bits'] == 16:
-                data = f.read(width * height * 2)
-                if j == 0:  # only load first mipmap
-                    pixel_bytes = _decode_16bit(data, color_extraction)
-            else:
-                raise Exception("Invalid file!")
-
-            if width != 1:
-                width //= 2
-            if height != 1:
-                height //= 2
-
-        # pixel_bytes contains the pixels for the largest mipmap level in RGBA order
-        x = bytes(itertools.chain.from_iterable(pixel_bytes))
-        img = Image.frombytes('RGBA', (org_width, org_height), x)
+        # only read the requested mipmap level (or the smallest one) and skip over the others
+        mipmap_dims = _get_mipmap_dims(width, height, mipmaps)
+        level = min(mip_level, mipmaps - 1)
+        f.seek(sum(w * h for w, h in mipmap_dims[:level]) * pixel_size, io.SEEK_CUR)
+        width, height = mipmap_dims[level]
+        data = f.read(width * height * pixel_size)
+        f.seek(sum(w * h for w, h in mipmap_dims[level + 1:]) * pixel_size, io.SEEK_CUR)
+
+        if pixel_size == 1:
+            pixel_bytes = _decode_8bit(data, palette, ts)
+        else:
+            pixel_bytes = _decode_16bit(data, color_extraction)
+
+        # pixel_bytes contains the pixels of the mipmap level in RGBA order
+        img = Image.frombytes('RGBA', (width, height), pixel_bytes)
         img = ImageOps.flip(img)
         frames.append(img)
 
     return frames
 
 
-def load_frames_from_file(f, colormap=None):
+def load_frames_from_file(f, colormap=None, mip_level=0):
     ident, version, mat_type, count, res1, res2 = struct.unpack(
         'Iiiiii', f.read(24))
     if ident != 542392653 or version != 50:
@@ -122,13 +135,34 @@ def load_frames_from_file(f, colormap=None):
     if mat_type == 0:
         return _read_colors(f, color_extraction, count, colormap)
     elif mat_type == 2:
-        return _read_textures(f, color_extraction, count, colormap)
+        return _read_textures(f, color_extraction, count, colormap, mip_level)
     else:
         raise Exception("Invalid file!")
 
 
-def load_frames_from_bytes(b, colormap=None):
-    return load_frames_from_file(io.BytesIO(b), colormap=colormap)
+class _MemoryReader:
+    # file-like access to a bytes-like object (e.g., a memoryview into a mapped GOB)
+    # that hands out slices instead of copies
+    def __init__(self, b):
+        self.view = memoryview(b)
+        self.pos = 0
+
+    def read(self, size):
+        data = self.view[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = offset
+        return self.pos
+
+
+def load_frames_from_bytes(b, colormap=None, mip_level=0):
+    return load_frames_from_file(_MemoryReader(b), colormap=colormap, mip_level=mip_level)
 
 
 if __name__ == "__main__":
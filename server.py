@@ -1,32 +1,42 @@
 from config import *
-from flask import Flask, Response, render_template, request, send_file, send_from_directory
+from flask import Flask, Response, abort, render_template, request, send_file, send_from_directory
 from flask_compress import Compress
 
-import base64
+import concurrent.futures
+import contextlib
+import glob
 import hashlib
 import io
 import json
+import multiprocessing
 import os
-import pygltflib
-import re
 import requests
 import shutil
-import struct
 import subprocess
 import tempfile
+import threading
+import time
 import urllib.parse
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import episode
+import glb
 import gob
-import loader
-import models
+import jkl
 
 app = Flask(__name__)
 Compress(app)
 
+# index the official game resources once when the worker starts
+gob.open_official_gobs()
+
 
 def _atomically_dump(f, target_path):
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(target_path), delete=False) as tmp_file:
         try:
             shutil.copyfileobj(f, tmp_file)
             shutil.move(tmp_file.name, target_path)
@@ -44,9 +54,36 @@ def _get_cache_filename(zip_url, episode_id, filename):
     return os.path.join('cache', '{0}-{1}-{2}'.format(cache_key, episode_id, filename))
 
 
+# archives share a fixed set of lock files, so that they don't pile up in the cache.
+# builds of archives that happen to share a file wait for each other
+BUILD_LOCK_COUNT = 256
+
+
+@contextlib.contextmanager
+def _cache_lock(zip_url, episode_id='all'):
+    # serializes building the cache of an archive across threads and worker processes:
+    # the first one builds, later ones wait and then find the result in the cache
+    if fcntl is None:
+        yield  # no file locks on this platform
+        return
+    lock_key = hashlib.sha1('{0}-{1}'.format(_get_cache_key(zip_url), episode_id).encode('utf-8')).digest()
+    lock_path = os.path.join('cache', 'build-{0}.lock'.format(
+        int.from_bytes(lock_key[:4], 'little') % BUILD_LOCK_COUNT))
+    with open(lock_path, 'wb') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def _write_cache_atomically(zip_url, episode_id, filename, mode, data):
-    target_path = _get_cache_filename(zip_url, episode_id, filename)
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
+    _write_file_atomically(_get_cache_filename(
+        zip_url, episode_id, filename), mode, data)
+
+
+def _write_file_atomically(target_path, mode, data):
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(target_path), delete=False) as tmp_file:
         try:
             with open(tmp_file.name, mode) as f:
                 f.write(data)
@@ -56,266 +93,218 @@ def _write_cache_atomically(zip_url, episode_id, filename, mode, data):
             raise
 
 
+# textures are stored once by their content hash, shared by all archives, and
+# referenced by the GLBs as ../textures/<name> (relative to /level/ and /skins/)
+TEXTURE_STORE_DIR = os.path.join('cache', 'textures')
+
+
+def _store_textures(textures):
+    os.makedirs(TEXTURE_STORE_DIR, exist_ok=True)
+    for name, image in textures.items():
+        path = os.path.join(TEXTURE_STORE_DIR, name)
+        if not os.path.exists(path):
+            _write_file_atomically(path, 'wb', image)
+
+
+# limits the number of gltfpack processes started by this server process
+_gltfpack_semaphore = threading.BoundedSemaphore(GLTFPACK_WORKERS)
+
+
 def _run_gltfpack(input_file_name, output_file_name):
     # extra flags:
     # -cc ... produce compressed gltf/glb files
     # -kn ... keep named nodes and meshes attached to named nodes (sky, individual skins)
     # -tc ... create KTX2 compressed textures
-    subprocess.run([GLTFPACK_PATH, '-i', input_file_name, '-o',
-                   output_file_name, '-cc', '-kn', '-tc'], check=True, timeout=60)
+    # -ke ... keep extras (level of detail distances)
+    with _gltfpack_semaphore:
+        subprocess.run([GLTFPACK_PATH, '-i', input_file_name, '-o',
+                       output_file_name, '-cc', '-kn', '-tc', '-ke'], check=True, timeout=60)
 
 
-def _write_optimized_glb_to_cache(zip_url, episode_id, filename, data):
+def _optimize_glb(data):
     # Write data to a temporary named file, invoke gltfpack to generate another
-    # named temporary file. Then move that file atomically to the cache directory
-    target_path = _get_cache_filename(zip_url, episode_id, filename)
+    # named temporary file and return its contents
     with tempfile.NamedTemporaryFile(suffix='.glb', delete=True) as tmp_input_file:
         with open(tmp_input_file.name, 'wb') as f:
             f.write(data)
-        with tempfile.NamedTemporaryFile(suffix='.glb', delete=False) as tmp_file:
+        with tempfile.NamedTemporaryFile(suffix='.glb', delete=True) as tmp_file:
+            _run_gltfpack(tmp_input_file.name, tmp_file.name)
+            with open(tmp_file.name, 'rb') as f:
+                return f.read()
+
+
+def _write_optimized_glb_to_cache(zip_url, episode_id, filename, data):
+    _write_cache_atomically(zip_url, episode_id,
+                            filename, 'wb', _optimize_glb(data))
+
+
+# reuse connections to the archive servers across downloads
+_http_session = requests.Session()
+
+
+def _download_zip(zip_url, zip_path, validators_path, headers):
+    # streams the archive to a temporary file next to zip_path and returns False if
+    # the server says that our copy is still up to date
+    deadline = time.monotonic() + DOWNLOAD_TIMEOUT
+    with _http_session.get(zip_url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        if r.status_code == 304:
+            return False
+        r.raise_for_status()
+        try:
+            content_length = int(r.headers.get('Content-Length', 0))
+        except ValueError:
+            content_length = 0  # unknown, the streamed size is checked below
+        if content_length > DOWNLOAD_MAX_SIZE:
+            raise Exception('archive too big!')
+
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(zip_path), delete=False) as tmp_file:
             try:
-                _run_gltfpack(tmp_input_file.name, tmp_file.name)
-                shutil.move(tmp_file.name, target_path)
+                size = 0
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    size += len(chunk)
+                    if size > DOWNLOAD_MAX_SIZE:
+                        raise Exception('archive too big!')
+                    if time.monotonic() > deadline:
+                        raise Exception('archive download timed out!')
+                    tmp_file.write(chunk)
+                tmp_file.flush()
+                shutil.move(tmp_file.name, zip_path)
             except:
                 os.remove(tmp_file.name)
                 raise
 
+        # remember how to ask the server whether the archive changed
+        validators = {}
+        if 'ETag' in r.headers:
+            validators['If-None-Match'] = r.headers['ETag']
+        if 'Last-Modified' in r.headers:
+            validators['If-Modified-Since'] = r.headers['Last-Modified']
+        with io.BytesIO(json.dumps(validators).encode()) as validators_data:
+            _atomically_dump(validators_data, validators_path)
+    return True
+
+
+def _invalidate_cache(zip_url):
+    # the archive changed: remove everything extracted from the previous one, so that
+    # it is extracted again
+    for path in glob.glob(_get_cache_filename(zip_url, '*', '*')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # removed by someone else
+
+    # and prefetch its maps again once one of them is shown
+    with _prefetched_zip_urls_lock:
+        _prefetched_zip_urls.discard(zip_url)
+
 
 def _fetch_zip(zip_url):
     cache_key = _get_cache_key(zip_url)
 
     zip_path = os.path.join('downloads', '{}.zip'.format(cache_key))
+    validators_path = os.path.join('downloads', '{}.json'.format(cache_key))
     if not os.path.isfile(zip_path):
-        r = requests.get(zip_url)
-        with io.BytesIO(r.content) as zip_data:
-            _atomically_dump(zip_data, zip_path)
+        _download_zip(zip_url, zip_path, validators_path, {})
+    elif time.time() - os.path.getmtime(zip_path) > DOWNLOAD_REVALIDATE_AFTER:
+        # our copy is old: download the archive again only if it has changed
+        try:
+            with open(validators_path, 'rt') as f:
+                validators = json.loads(f.read())
+        except:
+            validators = {}
+        if validators:
+            try:
+                if _download_zip(zip_url, zip_path, validators_path, validators):
+                    _invalidate_cache(zip_url)
+                else:
+                    os.utime(zip_path)  # still up to date
+            except:
+                pass  # keep using our copy
     return zip_path
 
 
-# divide vertex UVs by texture sizes
-def _normalize_uvs(surfaces, materials):
-    for surf in surfaces:
-        mat = materials[surf['material']]
-        if mat and 'dims' in mat:
-            sclu = 1.0 / mat['dims'][0]
-            sclv = 1.0 / mat['dims'][1]
-            for v in surf['vertices']:
-                v[1] = (v[1][0] * sclu, v[1][1] * sclv)
-
-
-def _make_materials_for_translucent_surfaces(surfaces, materials):
-    variants = {}
-    for surf in surfaces:
-        mat = surf['material']
-        if mat not in variants:
-            if surf['translucent']:
-                materials[mat]['translucent'] = True
-                variants[mat] = {'translucent': mat}
-            else:
-                variants[mat] = {'normal': mat}
-        else:
-            if surf['translucent']:
-                if 'translucent' not in variants[mat]:
-                    copy = materials[mat].copy()
-                    copy['translucent'] = True
-                    variants[mat]['translucent'] = len(materials)
-                    materials.append(copy)
-                surf['material'] = variants[mat]['translucent']
-            else:
-                if 'normal' not in variants[mat]:
-                    copy = materials[mat].copy()
-                    del copy['translucent']
-                    variants[mat]['normal'] = len(materials)
-                    materials.append(copy)
-                surf['material'] = variants[mat]['normal']
-
-
-def _add_materials_to_gltf(gltf, materials):
-    gltf.extensionsUsed.append('KHR_materials_unlit')
-    for mat in materials:
-        material = pygltflib.Material()
-        if mat and 'image' in mat:
-            buffer = pygltflib.Buffer(byteLength=len(mat['image']))
-            buffer.uri = 'data:application/octet-stream;base64,' + \
-                base64.b64encode(mat['image']).decode()
-            buffer_view = pygltflib.BufferView(buffer=len(
-                gltf.buffers), byteOffset=0, byteLength=buffer.byteLength)
-            image = pygltflib.Image(
-                mimeType=mat['mime'], bufferView=len(gltf.bufferViews))
-            texture = pygltflib.Texture(source=len(gltf.images))
-            material.pbrMetallicRoughness = pygltflib.PbrMetallicRoughness()
-            material.pbrMetallicRoughness.baseColorTexture = pygltflib.TextureInfo(
-                index=len(gltf.textures))
-            if 'translucent' in mat:
-                material.alphaMode = pygltflib.BLEND
-                material.pbrMetallicRoughness.baseColorFactor = [
-                    1.0, 1.0, 1.0, 90.0 / 255.0]
-                material.alphaCutoff = None
+# levels and skins are loaded by a pool of processes, shared by all extractions of this
+# server process, so that several of them can be loaded at once. it is created on first use
+_level_pool = None
+_level_pool_lock = threading.Lock()
+
+
+def _get_level_pool():
+    global _level_pool
+    with _level_pool_lock:
+        if _level_pool is None:
+            # the workers must not be forked from this process: one of its threads may
+            # hold a lock at that moment, which would then never be released in the worker
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['glb'])
             else:
-                material.alphaMode = pygltflib.MASK
-                material.alphaCutoff = 1.0 / 255.0
-            material.extensions['KHR_materials_unlit'] = {}
-            gltf.buffers.append(buffer)
-            gltf.bufferViews.append(buffer_view)
-            gltf.images.append(image)
-            gltf.textures.append(texture)
-        gltf.materials.append(material)
-
-
-def _add_surfaces_to_gltf(gltf, *surface_sources, **kwargs):
-    mesh = pygltflib.Mesh()
-    skip_color = kwargs.get('skip_color', False)
-
-    material_to_surfaces = {}
-    for surfaces in surface_sources:
-        for surf in surfaces:
-            if not surf['material'] in material_to_surfaces:
-                material_to_surfaces[surf['material']] = []
-            material_to_surfaces[surf['material']].append(surf)
-
-    vertex_data = bytearray()
-    vertex_data_buffer_view = len(gltf.bufferViews)
-    total_vertex_count = 0
-    vertexByteLength = 4 * (3 + 2) + (0 if skip_color else 4 * 3)
-
-    index_data = bytearray()
-    index_data_buffer_view_index = len(gltf.bufferViews) + 1
-    total_index_count = 0
-
-    for material, surfaces in material_to_surfaces.items():
-        bounds = None
-        index_count = 0
-        vertex_count = 0
-        vertex_data_buffer_offset = total_vertex_count * vertexByteLength
-        index_data_buffer_offset = total_index_count * 4
-
-        for surf in surfaces:
-            for v in surf['vertices']:
-                if bounds is None:
-                    bounds = [v[0], v[0]]
-                else:
-                    bounds[0] = [min(bounds[0][i], v[0][i]) for i in range(3)]
-                    bounds[1] = [max(bounds[1][i], v[0][i]) for i in range(3)]
-
-                vertex_data.extend(struct.pack('fff', *v[0]))
-                vertex_data.extend(struct.pack(
-                    'ff', v[1][0], -v[1][1]))  # flipY
-                if not skip_color:
-                    for i in range(3):
-                        vertex_data.extend(struct.pack(
-                            'f', max(0, min(1, v[2][i]))))
-            local_vertex_count = len(surf['vertices'])
-
-            for i in range(2, local_vertex_count):
-                index_data.extend(struct.pack(
-                    'III', vertex_count, vertex_count + i - 1, vertex_count + i))
-            local_index_count = 3 * (local_vertex_count - 2)
-
-            vertex_count += local_vertex_count
-            index_count += local_index_count
-
-        pos_accessor = pygltflib.Accessor(bufferView=vertex_data_buffer_view, byteOffset=vertex_data_buffer_offset, count=vertex_count,
-                                          componentType=pygltflib.FLOAT, type=pygltflib.VEC3, min=bounds[0], max=bounds[1])
-        uv_accessor = pygltflib.Accessor(bufferView=vertex_data_buffer_view, byteOffset=4*3+vertex_data_buffer_offset,
-                                         count=vertex_count, componentType=pygltflib.FLOAT, type=pygltflib.VEC2)
-        accessors = [len(gltf.accessors), len(gltf.accessors) + 1]
-        gltf.accessors.append(pos_accessor)
-        gltf.accessors.append(uv_accessor)
-        if not skip_color:
-            color_accessor = pygltflib.Accessor(bufferView=vertex_data_buffer_view, byteOffset=4*(
-                3+2)+vertex_data_buffer_offset, count=vertex_count, componentType=pygltflib.FLOAT, type=pygltflib.VEC3)
-            accessors.append(len(gltf.accessors))
-            gltf.accessors.append(color_accessor)
-
-        index_accessor = pygltflib.Accessor(bufferView=index_data_buffer_view_index, byteOffset=index_data_buffer_offset,
-                                            count=index_count, componentType=pygltflib.UNSIGNED_INT, type=pygltflib.SCALAR)
-        index_accessor_index = len(gltf.accessors)
-        gltf.accessors.append(index_accessor)
-
-        primitive = pygltflib.Primitive(
-            material=material, indices=index_accessor_index)
-        primitive.attributes.POSITION = accessors[0]
-        primitive.attributes.TEXCOORD_0 = accessors[1]
-        if not skip_color:
-            primitive.attributes.COLOR_0 = accessors[2]
-        mesh.primitives.append(primitive)
-
-        total_vertex_count += vertex_count
-        total_index_count += index_count
-
-    vertex_data_buffer = pygltflib.Buffer(byteLength=len(vertex_data))
-    vertex_data_buffer.uri = 'data:application/octet-stream;base64,' + \
-        base64.b64encode(vertex_data).decode()
-    vertex_data_buffer_view = pygltflib.BufferView(buffer=len(
-        gltf.buffers), byteOffset=0, byteStride=vertexByteLength, byteLength=vertex_data_buffer.byteLength, target=pygltflib.ARRAY_BUFFER)
-    gltf.buffers.append(vertex_data_buffer)
-    gltf.bufferViews.append(vertex_data_buffer_view)
-
-    index_data_buffer = pygltflib.Buffer(byteLength=len(index_data))
-    index_data_buffer.uri = 'data:application/octet-stream;base64,' + \
-        base64.b64encode(index_data).decode()
-    index_data_buffer_view = pygltflib.BufferView(buffer=len(
-        gltf.buffers), byteOffset=0, byteLength=index_data_buffer.byteLength, target=pygltflib.ELEMENT_ARRAY_BUFFER)
-    gltf.buffers.append(index_data_buffer)
-    gltf.bufferViews.append(index_data_buffer_view)
-
-    return mesh
+                context = multiprocessing.get_context('spawn')
+            _level_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=LEVEL_EXTRACTION_WORKERS, mp_context=context, initializer=glb.init_worker)
+        return _level_pool
+
+
+def _drop_level_pool(pool):
+    # a worker died (e.g. killed for using too much memory): start over with a new pool
+    global _level_pool
+    with _level_pool_lock:
+        if _level_pool is pool:
+            _level_pool = None
+    pool.shutdown(wait=False)
+
+
+def _run_in_level_pool(fn, *args):
+    pool = _get_level_pool()
+    try:
+        return pool.submit(fn, *args).result()
+    except concurrent.futures.process.BrokenProcessPool:
+        _drop_level_pool(pool)
+        raise
+
+
+def _extract_level(zip_url, episode_id, levelname):
+    zip_path = _fetch_zip(zip_url)
+    data, textures = _run_in_level_pool(
+        glb.build_level_glb, zip_path, levelname.encode())
+
+    # the map is ready once its GLB exists, so store its textures first
+    _store_textures(textures)
+
+    if GLTFPACK_PATH is None:
+        _write_cache_atomically(
+            zip_url, episode_id, 'map.glb', 'wb', data)
+    else:
+        _write_optimized_glb_to_cache(
+            zip_url, episode_id, 'map.glb', data)
 
 
 def _extract_map(zip_url):
+    # only scans the levels for their spawn points: the maps themselves are
+    # extracted on demand by _extract_level
     zip_path = _fetch_zip(zip_url)
     map_info = {'version': VERSION, 'title': 'Unknown', 'maps': []}
     try:
+        # the maps of a previous extraction may have different episode ids
+        for path in glob.glob(_get_cache_filename(zip_url, '*', 'map.glb')):
+            os.remove(path)
+
         # read the episode.jk file from the archive
         with gob.open_game_gobs_and_zip(zip_path) as vfs:
             info = episode.read_from_bytes(vfs.zip_gobs.read(b'episode.jk'))
             map_info['title'] = info.title.decode(errors='ignore')
 
-            # then try loading the referenced levels
+            # then try reading the things of the referenced levels
             for levelname in info.levels:
                 try:
-                    episode_id = len(map_info['maps'])
-                    surfaces, model_surfaces, sky_surfaces, materials, spawn_points = loader.load_level(
-                        b'jkl/' + levelname, vfs)
-
-                    for src in [surfaces, model_surfaces, sky_surfaces]:
-                        _normalize_uvs(src, materials)
-                        _make_materials_for_translucent_surfaces(
-                            src, materials)
-
-                    gltf = pygltflib.GLTF2()
-                    _add_materials_to_gltf(gltf, materials)
-
-                    mesh = _add_surfaces_to_gltf(
-                        gltf, surfaces, model_surfaces)
-                    node = pygltflib.Node(mesh=len(gltf.meshes))
-                    node.name = mesh.name = 'map'
-                    nodes = [len(gltf.nodes)]
-                    gltf.meshes.append(mesh)
-                    gltf.nodes.append(node)
-
-                    if sky_surfaces:
-                        mesh = _add_surfaces_to_gltf(gltf, sky_surfaces)
-                        sky_node = pygltflib.Node(mesh=len(gltf.meshes))
-                        sky_node.name = mesh.name = 'sky'
-                        nodes.append(len(gltf.nodes))
-                        gltf.meshes.append(mesh)
-                        gltf.nodes.append(sky_node)
-
-                    scene = pygltflib.Scene(nodes=nodes)
-                    gltf.scenes.append(scene)
-
-                    if GLTFPACK_PATH is None:
-                        _write_cache_atomically(
-                            zip_url, episode_id, 'map.glb', 'wb', b"".join(gltf.save_to_bytes()))
-                    else:
-                        _write_optimized_glb_to_cache(
-                            zip_url, episode_id, 'map.glb', b"".join(gltf.save_to_bytes()))
-
-                    if levelname.endswith(b'.jkl'):
-                        levelname = levelname[:-4]  # drop .jkl suffix
-                    map_info['maps'].append(
-                        {'name': levelname.decode(), 'spawnpoints': spawn_points})
+                    level = jkl.read_from_bytes(
+                        vfs.read(b'jkl/' + levelname), geometry=False)
+
+                    name = levelname
+                    if name.endswith(b'.jkl'):
+                        name = name[:-4]  # drop .jkl suffix
+                    map_info['maps'].append({'name': name.decode(), 'file': levelname.decode(),
+                                             'spawnpoints': level.spawn_points})
                 except:
                     if DEVELOPMENT_MODE:
                         raise
@@ -337,63 +326,16 @@ def _extract_skin(zip_url):
 
     skin_info = {'version': VERSION, 'skins': []}
     try:
-        # read the models.dat from the virtual file system
-        with gob.open_game_gobs_and_zip(zip_path) as vfs:
-            info = models.read_from_bytes(vfs.read(b'misc/models.dat'))
-            # Add single player models for MotS
-            info.models.append((b'kk.3do', 'Kyle Katarn'))
-            info.models.append((b'mj.3do', 'Mara Jade'))
-
-            # then locate models inside the archive
-            model_paths_and_names = [
-                m for m in info.models if vfs.zip_gobs.contains(b'3do/' + m[0])]
-            if len(model_paths_and_names) == 0:
-                # try to discover models in the gob
-                model_filename_pattern = re.compile(b'3do/(.+)\.3do')
-                for file in vfs.zip_gobs.ls():
-                    match = model_filename_pattern.match(file)
-                    if match:
-                        filename = match.group(1) + b'.3do'
-                        model_paths_and_names.append(
-                            (filename, filename.decode()))
-            if len(model_paths_and_names) == 0:
-                # probably just reskins Kyle
-                model_paths_and_names.append((b'ky.3do', 'Kyle Katarn'))
-
-            model_paths = [m[0] for m in model_paths_and_names]
-            surfaces, materials = loader.load_models(
-                model_paths, vfs, throw_on_error=DEVELOPMENT_MODE)
-
-            for i, model in enumerate(model_paths_and_names):
-                if surfaces[i] is None:
-                    continue
-
-                skin_info['skins'].append(model[1])
-                _normalize_uvs(surfaces[i], materials)
-                _make_materials_for_translucent_surfaces(
-                    surfaces[i], materials)
-
-            gltf = pygltflib.GLTF2()
-            _add_materials_to_gltf(gltf, materials)
-
-            for i, model in enumerate(model_paths_and_names):
-                mesh = _add_surfaces_to_gltf(
-                    gltf, surfaces[i], skip_color=True)
-                node = pygltflib.Node(mesh=len(gltf.meshes))
-                node.name = mesh.name = f'skin_{i}'
-                node_index = len(gltf.nodes)
-                gltf.meshes.append(mesh)
-                gltf.nodes.append(node)
-
-                scene = pygltflib.Scene(nodes=[node_index])
-                gltf.scenes.append(scene)
-
-            if GLTFPACK_PATH is None:
-                _write_cache_atomically(
-                    zip_url, 0, 'skins.glb', 'wb', b"".join(gltf.save_to_bytes()))
-            else:
-                _write_optimized_glb_to_cache(
-                    zip_url, 0, 'skins.glb', b"".join(gltf.save_to_bytes()))
+        skins, data, textures = _run_in_level_pool(glb.build_skins_glb, zip_path)
+
+        _store_textures(textures)
+        if GLTFPACK_PATH is None:
+            _write_cache_atomically(
+                zip_url, 0, 'skins.glb', 'wb', data)
+        else:
+            _write_optimized_glb_to_cache(
+                zip_url, 0, 'skins.glb', data)
+        skin_info['skins'] = skins
     except:
         if DEVELOPMENT_MODE:
             raise
@@ -423,25 +365,192 @@ def _get_zip_url():
     return url
 
 
+# extractions run in the background, so that requests for big archives don't block
+# a worker (and hit its timeout); the viewer polls the status until they are done
+_extraction_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=EXTRACTION_WORKERS)
+_extraction_jobs = {}
+_extraction_jobs_lock = threading.Lock()
+
+
+def _start_extraction(extract, zip_url, *args):
+    # concurrent requests for the same archive share a single job; if the job
+    # failed, the next request gets its error and may then start a new job
+    key = (extract.__name__, zip_url) + args
+    with _extraction_jobs_lock:
+        job = _extraction_jobs.get(key)
+        if job is not None and job.done():
+            del _extraction_jobs[key]
+            job.result()  # raises the error of the failed job
+            job = None
+        if job is not None:
+            return job
+        job = _extraction_pool.submit(extract, zip_url, *args)
+        _extraction_jobs[key] = job
+
+    def forget_successful_job(job):
+        if job.exception() is None:
+            with _extraction_jobs_lock:
+                if _extraction_jobs.get(key) is job:
+                    del _extraction_jobs[key]
+    job.add_done_callback(forget_successful_job)
+    return job
+
+
+def _read_cached_info(zip_url, filename):
+    info_path = _get_cache_filename(zip_url, 'all', filename)
+    if os.path.exists(info_path):
+        with open(info_path, 'rt') as f:
+            info = json.loads(f.read())
+            if 'version' in info and info['version'] == VERSION:
+                return info  # cached info exists and has correct version. use it!
+    return None
+
+
+def _build_mapinfo(zip_url):
+    with _cache_lock(zip_url):
+        if not DEVELOPMENT_MODE:
+            map_info = _read_cached_info(zip_url, 'mapinfo.json')
+            if map_info is not None:
+                return map_info  # built by someone else while we waited for the lock
+        return _extract_map(zip_url)
+
+
+def _get_mapinfo(zip_url):
+    # returns None while the map is being extracted
+    if DEVELOPMENT_MODE:
+        return _build_mapinfo(zip_url)  # synchronously, to see errors
+
+    map_info = _read_cached_info(zip_url, 'mapinfo.json')
+    if map_info is None:
+        _start_extraction(_build_mapinfo, zip_url)
+    return map_info
+
+
+def _build_map_glb(zip_url, episode_id, levelname):
+    with _cache_lock(zip_url, episode_id):
+        if not DEVELOPMENT_MODE and os.path.exists(_get_cache_filename(zip_url, episode_id, 'map.glb')):
+            return  # built by someone else while we waited for the lock
+        _extract_level(zip_url, episode_id, levelname)
+
+
+def _get_map_glb_job(zip_url, map_info, episode_id):
+    # returns None if the map is ready, otherwise the job extracting it
+    levelname = map_info['maps'][episode_id]['file']
+    if DEVELOPMENT_MODE:
+        _build_map_glb(zip_url, episode_id, levelname)  # synchronously, to see errors
+        return None
+
+    if os.path.exists(_get_cache_filename(zip_url, episode_id, 'map.glb')):
+        return None
+    return _start_extraction(_build_map_glb, zip_url, episode_id, levelname)
+
+
+# once a map is shown, the other maps of the episode are extracted in the background,
+# as many at once as the level pool loads, so that switching to them is quick.
+# maps requested meanwhile don't wait for this
+_prefetch_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=LEVEL_EXTRACTION_WORKERS)
+_prefetched_zip_urls = set()
+_prefetched_zip_urls_lock = threading.Lock()
+
+
+def _prefetch_map(zip_url, episode_id, levelname):
+    try:
+        _build_map_glb(zip_url, episode_id, levelname)
+    except:
+        pass  # the error is reported if the map is requested
+
+
+def _start_prefetch(zip_url, map_info):
+    if not PREFETCH_MAPS or DEVELOPMENT_MODE:
+        return
+    with _prefetched_zip_urls_lock:
+        if zip_url in _prefetched_zip_urls:
+            return
+        _prefetched_zip_urls.add(zip_url)
+    for episode_id, map in enumerate(map_info['maps']):
+        _prefetch_pool.submit(_prefetch_map, zip_url, episode_id, map['file'])
+
+
+def _is_episode_id_valid(map_info, episode_id):
+    return 0 <= episode_id < len(map_info['maps'])
+
+
+def _get_cache_revision(zip_url, episode_id, filename):
+    # changes whenever the cached file is written again, e.g. after its archive changed
+    try:
+        return str(os.stat(_get_cache_filename(zip_url, episode_id, filename)).st_mtime_ns)
+    except OSError:
+        return '0'
+
+
+def _send_cached_glb(zip_url, episode_id, filename):
+    # cached files only change with VERSION or their revision, which are part of their
+    # URLs, so they can be cached forever and revalidated by an ETag of both. conditional
+    # responses also answer range requests, e.g. to resume big downloads
+    path = os.path.abspath(_get_cache_filename(zip_url, episode_id, filename))
+    if not os.path.exists(path):
+        abort(404)
+
+    if DEVELOPMENT_MODE:
+        # extracted again on every request
+        return send_file(path, mimetype='model/gltf-binary', conditional=True)
+
+    revision = _get_cache_revision(zip_url, episode_id, filename)
+    etag = hashlib.sha1('{0}-{1}-{2}'.format(os.path.basename(path),
+                        VERSION, revision).encode()).hexdigest()
+    immutable = request.args.get('version') == str(
+        VERSION) and request.args.get('revision') == revision
+    response = send_file(path, mimetype='model/gltf-binary', etag=etag, conditional=True,
+                         max_age=365 * 24 * 60 * 60 if immutable else None)
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+
 @app.route('/level/map.glb')
 def root_level_map_data():
     zip_url = _get_zip_url()
     episode_id = int(request.args.get('episode', 0))
-    cache_key = _get_cache_key(zip_url)
-    filename = '{0}-{1}-{2}'.format(cache_key, episode_id, 'map.glb')
-    return send_from_directory('cache', filename, mimetype="model/gltf-binary")
+    if DEVELOPMENT_MODE and os.path.exists(_get_cache_filename(zip_url, episode_id, 'map.glb')):
+        # the viewer page rebuilt it just now, don't build it again
+        return _send_cached_glb(zip_url, episode_id, 'map.glb')
 
+    map_info = _get_mapinfo(zip_url)
+    if map_info is None:
+        map_info = _start_extraction(_build_mapinfo, zip_url).result()
+    if not _is_episode_id_valid(map_info, episode_id):
+        abort(404)
 
-def _get_mapinfo(zip_url):
-    if not DEVELOPMENT_MODE:
-        mapinfo_path = _get_cache_filename(zip_url, 'all', 'mapinfo.json')
-        if os.path.exists(mapinfo_path):
-            with open(mapinfo_path, 'rt') as f:
-                map_info = json.loads(f.read())
-                if 'version' in map_info and map_info['version'] == VERSION:
-                    return map_info  # cached info exists and has correct version. use it!
+    # extract the map on first access
+    job = _get_map_glb_job(zip_url, map_info, episode_id)
+    if job is not None:
+        job.result()
+
+    return _send_cached_glb(zip_url, episode_id, 'map.glb')
+
+
+@app.route('/textures/<name>')
+def root_texture(name):
+    # named by their content, so they never change
+    response = send_from_directory(
+        TEXTURE_STORE_DIR, name, max_age=365 * 24 * 60 * 60)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
-    return _extract_map(zip_url)
+
+@app.route('/level/status')
+def root_level_status():
+    zip_url = _get_zip_url()
+    episode_id = int(request.args.get('episode', 0))
+    map_info = _get_mapinfo(zip_url)
+    if map_info is None:
+        return {'ready': False}
+    if not _is_episode_id_valid(map_info, episode_id):
+        return {'ready': True}  # nothing to extract
+    return {'ready': _get_map_glb_job(zip_url, map_info, episode_id) is None}
 
 
 @app.route('/level/')
@@ -449,9 +558,17 @@ def root_level_viewer():
     zip_url = _get_zip_url()
     episode_id = int(request.args.get('episode', 0))
     map_info = _get_mapinfo(zip_url)
+    if map_info is not None and _is_episode_id_valid(map_info, episode_id):
+        if _get_map_glb_job(zip_url, map_info, episode_id) is not None:
+            map_info = None  # wait for the map, too
+        else:
+            _start_prefetch(zip_url, map_info)
+    if map_info is None:
+        return render_template('extracting.html', title='Level',
+                               status_url='status?' + urllib.parse.urlencode({'url': zip_url, 'episode': episode_id}))
 
-    map_glb = 'map.glb?version={0}&url={1}&episode={2}'.format(
-        VERSION, zip_url, episode_id)
+    map_glb = 'map.glb?version={0}&revision={1}&url={2}&episode={3}'.format(
+        VERSION, _get_cache_revision(zip_url, episode_id, 'map.glb'), zip_url, episode_id)
 
     maps = []
     for i, map in enumerate(map_info['maps']):
@@ -468,30 +585,45 @@ def root_level_viewer():
                            spawn_points=json.dumps(spawn_points), map_glb=map_glb, gltfpacked=gltfpacked)
 
 
+def _build_skininfo(zip_url):
+    with _cache_lock(zip_url):
+        if not DEVELOPMENT_MODE:
+            skin_info = _read_cached_info(zip_url, 'skininfo.json')
+            if skin_info is not None:
+                return skin_info  # built by someone else while we waited for the lock
+        return _extract_skin(zip_url)
+
+
 def _get_skininfo(zip_url):
-    if not DEVELOPMENT_MODE:
-        skininfo_path = _get_cache_filename(zip_url, 'all', 'skininfo.json')
-        if os.path.exists(skininfo_path):
-            with open(skininfo_path, 'rt') as f:
-                skin_info = json.loads(f.read())
-                if 'version' in skin_info and skin_info['version'] == VERSION:
-                    return skin_info  # cached info exists and has correct version. use it!
+    # returns None while the skins are being extracted
+    if DEVELOPMENT_MODE:
+        return _build_skininfo(zip_url)  # synchronously, to see errors
+
+    skin_info = _read_cached_info(zip_url, 'skininfo.json')
+    if skin_info is None:
+        _start_extraction(_build_skininfo, zip_url)
+    return skin_info
 
-    return _extract_skin(zip_url)
+
+@app.route('/skins/status')
+def root_skin_status():
+    zip_url = _get_zip_url()
+    return {'ready': _get_skininfo(zip_url) is not None}
 
 
 @app.route('/skins/skins.glb')
 def root_skin_skins_data():
     zip_url = _get_zip_url()
-    cache_key = _get_cache_key(zip_url)
-    filename = '{0}-{1}-{2}'.format(cache_key, 0, 'skins.glb')
-    return send_from_directory('cache', filename, mimetype="model/gltf-binary")
+    return _send_cached_glb(zip_url, 0, 'skins.glb')
 
 
 @app.route('/skins/')
 def root_skin_viewer():
     zip_url = _get_zip_url()
     skin_info = _get_skininfo(zip_url)
-    skins_glb = 'skins.glb?version={0}&url={1}'.format(VERSION, zip_url)
+    if skin_info is None:
+        return render_template('extracting.html', title='Skins', status_url='status?' + urllib.parse.urlencode({'url': zip_url}))
+    skins_glb = 'skins.glb?version={0}&revision={1}&url={2}'.format(
+        VERSION, _get_cache_revision(zip_url, 0, 'skins.glb'), zip_url)
     gltfpacked = GLTFPACK_PATH is not None
     return render_template('skinviewer.html', skins=json.dumps(skin_info['skins']), skins_glb=skins_glb, gltfpacked=gltfpacked)
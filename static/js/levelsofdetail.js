@@ -0,0 +1,23 @@
+import * as THREE from 'three';
+
+export function setupLevelsOfDetail(root) {
+    // nodes with lod_distances in their extras hold one child per level of detail
+    var groups = [];
+    root.traverse(function (object) {
+        if (object.userData.lod_distances) {
+            groups.push(object);
+        }
+    });
+    groups.forEach(function (group) {
+        var lod = new THREE.LOD();
+        lod.name = group.name;
+        lod.position.copy(group.position);
+        lod.quaternion.copy(group.quaternion);
+        lod.scale.copy(group.scale);
+        group.children.slice().forEach(function (child, i) {
+            lod.addLevel(child, group.userData.lod_distances[i]);
+        });
+        group.parent.add(lod);
+        group.parent.remove(group);
+    });
+}
@@ -0,0 +1,54 @@
+"""Benchmark for building the vertex and index arrays of large levels.
+
+Generates a synthetic level with a grid of box-shaped sectors, loads it and times
+how long glb._build_vertex_and_index_arrays takes for all of its surfaces:
+
+    python tests/bench_glb.py [--grid 60] [--repeat 5]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import conftest  # noqa: F401 puts the repository on sys.path, with a default config
+
+from levels import make_level_zip
+
+
+def best_time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--grid', type=int, default=60, help='sectors per side of the level')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    import gob
+    import glb
+    import loader
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)  # no official GOBs
+        make_level_zip('level.zip', args.grid)
+        with gob.open_game_gobs_and_zip('level.zip') as vfs:
+            surfaces = loader.load_level(b'jkl/test.jkl', vfs)[0]
+        os.chdir(cwd)
+
+    vertex_count = sum(len(surf['vertices']) for surf in surfaces)
+    for skip_color in (False, True):
+        elapsed = best_time(lambda: glb._build_vertex_and_index_arrays(surfaces, skip_color), args.repeat)
+        print('{:10} {:.3f}s ({} surfaces, {} vertices)'.format(
+            'uncolored' if skip_color else 'colored', elapsed, len(surfaces), vertex_count))
+
+
+if __name__ == '__main__':
+    main()
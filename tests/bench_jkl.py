@@ -0,0 +1,58 @@
+"""Parse benchmark for large JKL levels.
+
+Generates a synthetic level with a grid of box-shaped sectors and times how long
+jkl.read_from_bytes takes to parse it, in the JK and the MotS flavor:
+
+    python tests/bench_jkl.py [--grid 60] [--baseline path/to/old/jkl.py]
+
+With --baseline, another version of jkl.py is timed on the same levels as well.
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from levels import make_level
+
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location('baseline_jkl', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def best_time(module, data, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        module.read_from_bytes(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--grid', type=int, default=60, help='sectors per side of the level')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', help='another jkl.py to compare with')
+    args = parser.parse_args()
+
+    import jkl
+    modules = [('current', jkl)]
+    if args.baseline:
+        modules.append(('baseline', load_module(args.baseline)))
+
+    for flavor in ('jk', 'mots'):
+        data = make_level(args.grid, mots=flavor == 'mots')
+        for name, module in modules:
+            print('{:5} {:8} {:.3f}s ({} surfaces, {} bytes)'.format(
+                flavor, name, best_time(module, data, args.repeat), 6 * args.grid * args.grid, len(data)))
+
+
+if __name__ == '__main__':
+    main()
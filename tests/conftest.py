@@ -0,0 +1,17 @@
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+# the modules live at the top of the repository
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+# without an installation's config.py, test with the default configuration
+try:
+    import config
+except ImportError:
+    loader = importlib.machinery.SourceFileLoader('config', os.path.join(ROOT, 'config.py-default'))
+    config = importlib.util.module_from_spec(importlib.util.spec_from_loader('config', loader))
+    loader.exec_module(config)
+    sys.modules['config'] = config
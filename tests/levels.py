@@ -0,0 +1,75 @@
+"""Synthetic game data for the tests and benchmarks."""
+import random
+import struct
+import zipfile
+
+QUADS = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1),
+         (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+
+
+def make_level(grid, mots=False, tiled=True, seed=1234):
+    # a JKL with a grid of box-shaped sectors. unless tiled, the surfaces don't scale
+    # their textures, which then cover each surface exactly once
+    r = random.Random(seed)
+    lines = ['# synthetic level', 'SECTION: JK', 'Version 1', '',
+             'SECTION: MATERIALS', 'World materials 4',
+             '0: dflt.mat 1.000000 1.000000', '1: wall.mat 1.000000 1.000000',
+             '2: floor.mat 1.000000 1.000000', '3: sky.mat 1.000000 1.000000', 'end', '',
+             'SECTION: GEORESOURCE', 'World Colormaps 1', '0: dflt.cmp', '']
+
+    sectors = grid * grid
+    lines.append('World vertices {}'.format(8 * sectors))
+    for s in range(sectors):
+        for k in range(8):
+            lines.append('{}: {:.6f} {:.6f} {:.6f}'.format(
+                8 * s + k, s % grid + (k & 1), s // grid + ((k >> 1) & 1), (k >> 2) * 0.5))
+    lines.append('')
+
+    lines.append('World texture vertices {}'.format(4 * sectors))
+    for i in range(4 * sectors):
+        lines.append('{}:\t{:.6f}\t{:.6f}'.format(i, r.uniform(0, 64), r.uniform(0, 64)))
+    lines.append('')
+
+    lines.append('World surfaces {}'.format(6 * sectors))
+    for s in range(sectors):
+        for q, quad in enumerate(QUADS):
+            rest = ' '.join('{},{}'.format(8 * s + k, 4 * s + i if r.random() > 0.1 else -1)
+                            for i, k in enumerate(quad))
+            intensities = ' '.join('{:.6f}'.format(r.random()) for _ in range(16 if mots else 4))
+            lines.append('{}:\t{}\t0x{:x}\t0x{:x}\t4\t{}\t4\t-1\t{:.6f}\t4\t{}\t{}'.format(
+                6 * s + q, r.randrange(4), r.choice([0x4, 0x14, 0x24, 0x44]) if tiled else 0x4, r.choice([0x0, 0x1, 0x2]),
+                r.choice([1, 3, 3, 3]), r.uniform(0, 0.2), rest, intensities))
+    lines.append('')
+    for i in range(6 * sectors):
+        lines.append('{}:\t0.0\t0.0\t1.0'.format(i))
+    lines.append('')
+
+    lines += ['SECTION: SECTORS', 'World sectors {}'.format(sectors)]
+    for s in range(sectors):
+        lines += ['SECTOR\t{}'.format(s), 'FLAGS\t0x0', 'AMBIENT LIGHT\t0.2', 'EXTRA LIGHT\t0.1',
+                  'COLORMAP\t0', 'BOUNDBOX {} {} 0 {} {} 0.5'.format(s % grid, s // grid, s % grid + 1, s // grid + 1),
+                  'VERTICES 8', '0: 0', 'SURFACES\t{}\t6'.format(6 * s), '']
+
+    lines += ['SECTION: TEMPLATES', 'World templates 1', 'walkplayer\tnone\ttype=player', 'end', '',
+              'SECTION: Things', 'World things 1',
+              '0: walkplayer walkplayer 0.5 0.5 0.1 0.0 0.0 0.0 0', 'end']
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+def make_mat(width, height, seed=0):
+    # an 8-bit MAT with a single texture and its mipmaps
+    r = random.Random(seed)
+    data = struct.pack('Iiiiii', 542392653, 50, 2, 1, 1, 0)
+    data += struct.pack('i' * 13, 8, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    data += struct.pack('iIiiiiiiii', 8, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+    data += struct.pack('iiiiii', width, height, 0, 0, 0, 2)
+    data += bytes(r.randrange(256) for _ in range(width * height + (width // 2) * (height // 2)))
+    return data
+
+
+def make_level_zip(path, grid, mots=False, tiled=True):
+    # an archive with the level as jkl/test.jkl and the materials it uses
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('jkl/test.jkl', make_level(grid, mots=mots, tiled=tiled))
+        for i, name in enumerate(['dflt', 'wall', 'floor', 'sky']):
+            z.writestr('mat/{}.mat'.format(name), make_mat(64, 64, seed=i))
@@ -0,0 +1,27 @@
+import pygltflib
+
+import glb
+from levels import make_level_zip
+
+
+def _build_level(tmp_path, monkeypatch, atlas_size):
+    monkeypatch.chdir(tmp_path)  # no official GOBs
+    monkeypatch.setattr(glb, 'TEXTURE_ATLAS_SIZE', atlas_size)
+    zip_path = tmp_path / 'level.zip'
+    make_level_zip(zip_path, 3, tiled=False)
+    data, _ = glb.build_level_glb(str(zip_path), b'test.jkl')
+    return pygltflib.GLTF2.load_from_bytes(data)
+
+
+def test_build_level_glb(tmp_path, monkeypatch):
+    gltf = _build_level(tmp_path, monkeypatch, None)
+    assert [mesh.name for mesh in gltf.meshes] == ['map']
+    assert len(gltf.images) == len(gltf.meshes[0].primitives) > 2
+
+
+def test_build_level_glb_with_atlases(tmp_path, monkeypatch):
+    # the textures cover their surfaces exactly once, so the opaque and the translucent
+    # ones are packed into an atlas each, and the map is drawn with one primitive per atlas
+    gltf = _build_level(tmp_path, monkeypatch, 512)
+    assert [mesh.name for mesh in gltf.meshes] == ['map']
+    assert len(gltf.images) == len(gltf.meshes[0].primitives) == 2
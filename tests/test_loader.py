@@ -0,0 +1,63 @@
+import math
+import random
+
+import numpy as np
+
+import loader
+
+
+def test_cache_keeps_value_when_disk_write_fails(tmp_path):
+    # the directory is missing, as if it were on a disk that failed
+    cache = loader.ContentCache(1024, len, 'test', str(tmp_path / 'missing'), 1024)
+    cache.put('key', b'value')
+    assert cache.get('key') == b'value'
+
+
+def test_cache_reads_value_from_disk(tmp_path):
+    cache = loader.ContentCache(1024, len, 'test', str(tmp_path), 1024)
+    cache.put('key', b'value')
+    other = loader.ContentCache(1024, len, 'test', str(tmp_path), 1024)
+    assert other.get('key') == b'value'
+
+
+# the scalar per-vertex lighting that loader.py used before lighting all vertices of
+# a mesh at once, as a reference
+
+def _reference_apply_lighting(v, sector, lights):
+    pos = v[0]
+    length = math.sqrt(v[3][0] * v[3][0] + v[3][1] * v[3][1] + v[3][2] * v[3][2])
+    n = v[3] if length == 0 else (v[3][0] / length, v[3][1] / length, v[3][2] / length)
+    total = sector.get('ambient_light', 0) if sector else 0
+    for light in lights:
+        lpos = (light['pos'][0] + light['offset'][0], light['pos'][1] +
+                light['offset'][1], light['pos'][2] + light['offset'][2])
+        l = (lpos[0] - pos[0], lpos[1] - pos[1], lpos[2] - pos[2])
+        distance = math.sqrt(l[0] * l[0] + l[1] * l[1] + l[2] * l[2])
+        range = light['intensity'] * 1.25 * 2
+        if distance >= range:
+            continue
+        ndotl = (n[0] * l[0] + n[1] * l[1] + n[2] * l[2]) / distance
+        if ndotl > 0:
+            total += ndotl * (1 - distance / range) * light['light']
+    extra_light = sector.get('extra_light', 0) if sector else 0
+    l = total + extra_light
+    return [min(1, c + l) for c in v[2]]
+
+
+def test_compute_lighting():
+    r = random.Random(1234)
+    lights = [{'pos': [r.uniform(0, 10) for _ in range(3)], 'offset': [r.uniform(-0.1, 0.1) for _ in range(3)],
+               'intensity': r.uniform(0.1, 3), 'light': r.uniform(0, 0.02)} for _ in range(300)]
+    vertices = [([r.uniform(0, 10) for _ in range(3)], (0, 0), [r.uniform(0, 0.5) for _ in range(3)],
+                 [r.uniform(-1, 1) for _ in range(3)]) for _ in range(500)]
+    vertices.append(([5, 5, 5], (0, 0), [0, 0, 0], [0, 0, 0]))  # no normal
+    sector = {'ambient_light': 0.1, 'extra_light': 0.05}
+
+    positions = np.array([v[0] for v in vertices], dtype=np.float64)
+    normals = np.array([v[3] for v in vertices], dtype=np.float64)
+    light = loader._compute_lighting(positions, normals, sector, loader._make_light_arrays(lights))
+    colors = np.minimum(1, np.array([v[2] for v in vertices], dtype=np.float64) + light[:, np.newaxis])
+
+    expected = np.array([_reference_apply_lighting(v, sector, lights) for v in vertices])
+    assert len(light) == len(vertices)
+    assert np.allclose(colors, expected, rtol=0, atol=1e-12)
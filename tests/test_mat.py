@@ -0,0 +1,89 @@
+import itertools
+import random
+
+import mat
+
+LAYOUTS = {
+    '565': {
+        'total_bits': 16,
+        'channel_bits': (5, 6, 5),
+        'channel_shifts': (11, 5, 0),
+        'channel_expands': (3, 2, 3)
+    },
+    '1555': {
+        'total_bits': 16,
+        'channel_bits': (5, 5, 5),
+        'channel_shifts': (10, 5, 0),
+        'channel_expands': (3, 3, 3)
+    },
+}
+
+
+# the scalar decoders that mat.py used before decoding with numpy, as a reference
+
+def _reference_decode_16bit(data, color_extraction):
+    sr, sg, sb = [x for x in color_extraction['channel_shifts']]
+    mr, mg, mb = [(1 << bits) - 1 for bits in color_extraction['channel_bits']]
+    er, eg, eb = [x for x in color_extraction['channel_expands']]
+
+    colors = []
+    for i in range(0, len(data), 2):
+        val = data[i] | (data[i + 1] << 8)
+        r = ((val >> sr) & mr) << er
+        g = ((val >> sg) & mg) << eg
+        b = ((val >> sb) & mb) << eb
+        a = 255
+        colors.append((r, g, b, a))
+    return bytes(itertools.chain.from_iterable(colors))
+
+
+def _set_alpha(rgba, lhs, rhs):
+    return (rgba[0], rgba[1], rgba[2], 0) if lhs == rhs else rgba
+
+
+def _reference_decode_8bit(data, colormap, ts):
+    if colormap:
+        pixel_bytes = [_set_alpha(colormap[i], i, ts) for i in data]
+    else:
+        pixel_bytes = [_set_alpha((i, i, i, 255), i, ts) for i in data]
+    return bytes(itertools.chain.from_iterable(pixel_bytes))
+
+
+def _random_bytes(rng, n):
+    return bytes(rng.randrange(256) for _ in range(n))
+
+
+def _random_colormap(rng):
+    return [(rng.randrange(256), rng.randrange(256), rng.randrange(256), 255) for _ in range(256)]
+
+
+def test_decode_16bit_matches_reference():
+    rng = random.Random(16)
+    for name, color_extraction in LAYOUTS.items():
+        data = _random_bytes(rng, 2 * 4096)
+        assert mat._decode_16bit(data, color_extraction) == _reference_decode_16bit(
+            data, color_extraction), name
+
+
+def test_decode_16bit_all_values():
+    data = bytes(itertools.chain.from_iterable((v & 0xff, v >> 8) for v in range(65536)))
+    for name, color_extraction in LAYOUTS.items():
+        assert mat._decode_16bit(data, color_extraction) == _reference_decode_16bit(
+            data, color_extraction), name
+
+
+def test_decode_8bit_matches_reference():
+    rng = random.Random(8)
+    data = _random_bytes(rng, 4096)
+    for colormap in (None, _random_colormap(rng)):
+        palette = mat._make_palette(colormap)
+        for ts in (-1, 0, data[0], 255):  # without and with a transparent color
+            assert mat._decode_8bit(data, palette, ts) == _reference_decode_8bit(
+                data, colormap, ts), (colormap is None, ts)
+
+
+def test_decode_8bit_keeps_palette():
+    # a transparent color must not leak into the palette shared by the frames of a MAT
+    palette = mat._make_palette(None)
+    mat._decode_8bit(bytes(range(256)), palette, 7)
+    assert palette[7, 3] == 255
@@ -197,8 +197,9 @@ class ThreedoFile:
                 curmesh[key] = {'vertices': vertices, 'geo': geo,
                                 'material': mat, 'translucent': translucent}
 
-        # keep only the highest resolution (geoset 0)
-        self.meshes = geosets[0]
+        # keep all geosets, from the highest resolution (geoset 0) to the lowest
+        self.geosets = [geosets[key] for key in sorted(geosets)]
+        self.meshes = self.geosets[0]
 
 
 def _strip(line):